@@ -1,5 +1,5 @@
 import geopandas as gpd
-import zipfile
+import shapely
 import pyogrio
 import numpy as np
 import pandas as pd
@@ -7,52 +7,86 @@ import glob, os
 
 """
 This stage loads the raw data from the Bavarian building registry.
+
+The archives are read directly and in parallel. Only the centroids of the buildings
+that pass the area filter are kept, and the result is a point table with x and y
+coordinates instead of geometries.
 """
 
+# Number of building footprints that are read at once
+BATCH_SIZE = 1000000
+
 def configure(context):
     context.config("data_path")
     context.config("bavaria.buildings_path", "bavaria/buildings")
-    
+
+    # Store the coordinates in single precision to reduce memory
+    context.config("bavaria.buildings_float32", False)
+
     context.stage("bavaria.data.spatial.iris")
 
-def execute(context):
-    df_zones = context.stage("bavaria.data.spatial.iris")
-    df_combined = []
-    
-    start_index = 0
-    for path in glob.glob("{}/{}/*_Hausumringe.zip".format(context.config("data_path"), context.config("bavaria.buildings_path"))):
-        print("Processing", path.split("/")[-1].split("_Haus")[0])
-        
-        # Load buildings
-        with zipfile.ZipFile(path) as archive:
-            archive.extractall(context.path())
+def process_archive(context, path):
+    df_zones = context.data("df_zones")
+    dtype = np.float32 if context.data("float32") else np.float64
+
+    source = "/vsizip/{}/hausumringe.shp".format(path)
+    feature_count = pyogrio.read_info(source)["features"]
+
+    df_buildings = []
+
+    for offset in range(0, feature_count, BATCH_SIZE):
+        geometry = pyogrio.read_dataframe(source, columns = [],
+            skip_features = offset, max_features = BATCH_SIZE)["geometry"].values
 
-        df_buildings = pyogrio.read_dataframe("{}/hausumringe.shp".format(
-            context.path()), columns = [])[["geometry"]]
-        
-        # Weighting by area
-        df_buildings["weight"] = df_buildings.area
+        # Weighting by area and filter
+        weight = shapely.area(geometry)
+        f = (weight >= 40) & (weight < 400)
 
-        # Attributes
-        df_buildings["building_id"] = np.arange(len(df_buildings)) + start_index
-        start_index += len(df_buildings) + 1
+        coordinates = shapely.get_coordinates(shapely.centroid(geometry[f]))
 
-        df_buildings["geometry"] = df_buildings.centroid
+        df_buildings.append(pd.DataFrame({
+            "index": np.flatnonzero(f) + offset,
+            "weight": weight[f],
+            "x": coordinates[:,0], "y": coordinates[:,1]
+        }))
 
-        # Filter
-        df_buildings = df_buildings[
-            (df_buildings["weight"] >= 40) & (df_buildings["weight"] < 400)
-        ].copy()
+        context.progress.update(min(BATCH_SIZE, feature_count - offset))
 
-        # Impute spatial identifiers
-        df_buildings = gpd.sjoin(df_buildings, df_zones[["geometry", "commune_id", "iris_id"]], 
-            how = "left", predicate = "within").reset_index(drop = True).drop(columns = ["index_right"])
+    df_buildings = pd.concat(df_buildings, ignore_index = True)
 
-        df_combined.append(df_buildings[[
-            "building_id", "weight", "commune_id", "iris_id", "geometry"
-        ]])
+    # Impute spatial identifiers
+    df_buildings = gpd.sjoin(
+        gpd.GeoDataFrame(df_buildings, geometry = gpd.points_from_xy(df_buildings["x"], df_buildings["y"]), crs = df_zones.crs),
+        df_zones[["geometry", "commune_id", "iris_id"]], how = "left", predicate = "within"
+    ).reset_index(drop = True)
 
-    df_combined = gpd.GeoDataFrame(pd.concat(df_combined), crs = df_combined[0].crs)
+    df_buildings["x"] = df_buildings["x"].astype(dtype)
+    df_buildings["y"] = df_buildings["y"].astype(dtype)
+
+    return feature_count, pd.DataFrame(df_buildings[["index", "weight", "commune_id", "iris_id", "x", "y"]])
+
+def execute(context):
+    df_zones = context.stage("bavaria.data.spatial.iris")
+    dtype = np.float32 if context.config("bavaria.buildings_float32") else np.float64
+
+    paths = glob.glob("{}/{}/*_Hausumringe.zip".format(context.config("data_path"), context.config("bavaria.buildings_path")))
+    total = sum(pyogrio.read_info("/vsizip/{}/hausumringe.shp".format(path))["features"] for path in paths)
+
+    df_combined = []
+    start_index = 0
+
+    with context.progress(label = "Processing buildings ...", total = total) as progress:
+        with context.parallel(dict(df_zones = df_zones, float32 = context.config("bavaria.buildings_float32"))) as parallel:
+            for feature_count, df_buildings in parallel.imap(process_archive, paths):
+                # Attributes
+                df_buildings["building_id"] = df_buildings["index"] + start_index
+                start_index += feature_count + 1
+
+                df_combined.append(df_buildings[[
+                    "building_id", "weight", "commune_id", "iris_id", "x", "y"
+                ]])
+
+    df_combined = pd.concat(df_combined)
 
     required_zones = set(df_zones["commune_id"].unique())
     available_zones = set(df_combined["commune_id"].unique())
@@ -62,12 +96,13 @@ def execute(context):
         print("Adding {} centroids as buildings for missing municipalities".format(len(missing_zones)))
 
         df_missing = df_zones[df_zones["commune_id"].isin(missing_zones)][["commune_id", "iris_id", "geometry"]].copy()
-        df_missing["geometry"] = df_missing["geometry"].centroid
+        df_missing["x"] = df_missing["geometry"].centroid.x.astype(dtype)
+        df_missing["y"] = df_missing["geometry"].centroid.y.astype(dtype)
         df_missing["building_id"] = np.arange(len(df_missing)) + start_index
         df_missing["weight"] = 1.0
 
-        df_combined = pd.concat([df_combined, df_missing])
-    
+        df_combined = pd.concat([df_combined, df_missing.drop(columns = ["geometry"])])
+
     return df_combined
 
 def validate(context):
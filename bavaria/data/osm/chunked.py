@@ -1,11 +1,19 @@
 import bavaria.data.osm.osmconvert
-import os
+import os, shutil, hashlib
 
 """
 The purpose of this stage is to cut the OSM data into smaller chunks so we can process
 it more easily later on.
+
+The data is cut hierarchically: first by Regierungsbezirk from the full file, then by
+Landkreis from the extract of the Regierungsbezirk and finally by municipality from the
+extract of the Landkreis. Optionally, all extracts are kept in a cache directory so that
+only missing regions are cut when the study area changes.
 """
 
+# Lengths of the identifier prefixes of the Regierungsbezirke and Landkreise
+LEVELS = [3, 5]
+
 def configure(context):
     context.stage("data.spatial.municipalities")
     context.stage("bavaria.data.osm.osmconvert")
@@ -15,48 +23,112 @@ def configure(context):
     context.config("data_path")
     context.config("osm_path_bavaria", "osm/bayern-latest.osm.pbf")
 
-def process_municipality(context, zone_id):
-    input_path = context.data("input_path")
+    # Optional directory in which extracts are kept across runs
+    context.config("osm_cache_path", None)
+
+def create_poly(geometry):
+    if not hasattr(geometry, "exterior"):
+        geometry = geometry.convex_hull
+
+    data = []
+    data.append("polyfile")
+    data.append("polygon")
+
+    for coordinate in geometry.exterior.coords:
+        data.append("    %e    %e" % coordinate[:2])
+
+    data.append("END")
+    data.append("END")
+
+    return "\n".join(data)
+
+def process_zone(context, arguments):
+    input_path, zone_id, cache_file = arguments
     local_path = context.data("local_path")
+    output_path = "{}/{}.osm.pbf".format(local_path, zone_id)
+
+    if not cache_file is None and os.path.exists(cache_file):
+        shutil.copyfile(cache_file, output_path)
+
+    else:
+        bavaria.data.osm.osmconvert.run(context, [input_path,
+            "-B={}".format("{}/{}.poly".format(local_path, zone_id)),
+            "-o={}".format(output_path)], cwd = local_path)
+
+        if not cache_file is None:
+            shutil.copyfile(output_path, cache_file + ".tmp")
+            os.replace(cache_file + ".tmp", cache_file)
 
-    bavaria.data.osm.osmconvert.run(context, [input_path,
-        "-B={}".format("{}/{}.poly".format(local_path, zone_id)),
-        "-o={}".format("{}/{}.osm.pbf".format(local_path, zone_id))], cwd = local_path)
-    
     return zone_id
-    
+
 def execute(context):
-    # Load zones and convert to polyfiles
+    # Load zones
     df_zones = context.stage("data.spatial.municipalities")[["commune_id", "geometry"]]
     df_zones = df_zones.to_crs("EPSG:4326")
 
-    for zone_id, geometry in df_zones.itertuples(index = False):
-        if not hasattr(geometry, "exterior"):
-            geometry = geometry.convex_hull
+    input_path = "{}/{}".format(context.config("data_path"), context.config("osm_path_bavaria"))
+
+    # Prepare the cache, extracts are only valid for the same input file
+    cache_path = context.config("osm_cache_path")
+
+    if not cache_path is None:
+        cache_path = "{}/{}".format(cache_path, hashlib.md5("{};{};{}".format(
+            os.path.abspath(input_path), os.path.getsize(input_path), os.path.getmtime(input_path)
+        ).encode("utf-8")).hexdigest())
+
+        os.makedirs(cache_path, exist_ok = True)
+
+    # Define the hierarchy of regions, the municipalities being the last level
+    df_zones["zone_id"] = df_zones["commune_id"].astype(str)
+    levels = []
+
+    for length in LEVELS:
+        df_level = df_zones[["zone_id", "geometry"]].copy()
+        df_level["zone_id"] = df_level["zone_id"].str[:length]
+        levels.append(df_level.dissolve(by = "zone_id").reset_index())
+
+    levels.append(df_zones[["zone_id", "geometry"]])
+
+    # Define the tasks bottom-up, a region is only cut if one of its subregions is missing in the cache
+    tasks = []
+    required = None
+
+    for index in reversed(range(len(levels))):
+        parent_length = LEVELS[index - 1] if index > 0 else None
+        level_tasks = []
+
+        for zone_id, geometry in levels[index][["zone_id", "geometry"]].itertuples(index = False):
+            if not required is None and not zone_id in required:
+                continue
+
+            poly = create_poly(geometry)
+
+            with open("{}/{}.poly".format(context.path(), zone_id), "w+") as f:
+                f.write(poly)
+
+            zone_input_path = input_path if parent_length is None else \
+                "{}/{}.osm.pbf".format(context.path(), zone_id[:parent_length])
+
+            cache_file = None if cache_path is None else "{}/{}_{}.osm.pbf".format(
+                cache_path, zone_id, hashlib.md5(poly.encode("utf-8")).hexdigest())
 
-        data = []
-        data.append("polyfile")
-        data.append("polygon")
+            level_tasks.append((zone_input_path, zone_id, cache_file))
 
-        for coordinate in geometry.exterior.coords:
-            data.append("    %e    %e" % coordinate[:2])
+        required = set([
+            zone_id[:parent_length] for _, zone_id, cache_file in level_tasks
+            if cache_file is None or not os.path.exists(cache_file)
+        ]) if not parent_length is None else None
 
-        data.append("END")
-        data.append("END")
+        tasks.insert(0, level_tasks)
 
-        with open("{}/{}.poly".format(context.path(), zone_id), "w+") as f:
-            f.write("\n".join(data))
-    
-    # Cut into chunks
-    with context.progress(label = "Chunking OSM data ...", total = len(df_zones)) as progress:
-        with context.parallel({
-            "input_path": "{}/{}".format(context.config("data_path"), context.config("osm_path_bavaria")),
-            "local_path": context.path()
-        }) as parallel:
-            for item in parallel.imap(process_municipality, df_zones["commune_id"].values):
-                progress.update()
+    # Cut into chunks, level by level
+    with context.progress(label = "Chunking OSM data ...", total = sum(len(level_tasks) for level_tasks in tasks)) as progress:
+        with context.parallel({ "local_path": context.path() }) as parallel:
+            for level_tasks in tasks:
+                for item in parallel.imap(process_zone, level_tasks):
+                    progress.update()
 
     return df_zones["commune_id"].values
 
 def validate(context):
-    return os.path.getsize("{}/{}".format(context.config("data_path"), context.config("osm_path_bavaria")))
\ No newline at end of file
+    return os.path.getsize("{}/{}".format(context.config("data_path"), context.config("osm_path_bavaria")))
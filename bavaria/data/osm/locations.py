@@ -41,58 +41,112 @@ def configure(context):
     context.stage("data.spatial.municipalities")
     context.stage("data.spatial.iris")
 
-def execute(context):
-    df_zones = context.stage("data.spatial.iris")[["geometry", "commune_id", "iris_id"]]
-    chunk_ids = context.stage("bavaria.data.osm.chunked")
+def create_union_filter(osm_filters):
+    """
+        Creates one filter that selects all buildings of the given filters. Note
+        that pyrosm selects all buildings if a filter does not refer to the
+        building tag, so we do the same.
+    """
+    union_filter = {}
+
+    for osm_filter in osm_filters:
+        for key, values in osm_filter["filter"].items():
+            union_filter[key] = sorted(set(union_filter.get(key, [])) | set(values))
+
+    if any(not "building" in osm_filter["filter"] for osm_filter in osm_filters):
+        union_filter["building"] = [True]
+
+    return union_filter
+
+def apply_filter(df, osm_filter):
+    f = np.zeros((len(df),), dtype = bool)
+
+    for key, values in osm_filter.items():
+        if key in df:
+            f |= df[key].isin(values).values
+
+    if not "building" in osm_filter and "building" in df:
+        f |= df["building"].notna().values
+
+    return f
+
+def process_chunk(context, arguments):
+    chunk, df_local = arguments
+    osm = pyrosm.OSM("{}/{}.osm.pbf".format(context.data("input_path"), chunk))
+
+    try:
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", category = UserWarning)
+            warnings.filterwarnings("ignore", category = FutureWarning)
+
+            df_buildings = osm.get_buildings(create_union_filter(OSM_FILTERS))
+    except AttributeError:
+        df_buildings = None
+    except KeyError:
+        df_buildings = None
+
+    df_locations = {}
+
+    if df_buildings is not None and len(df_buildings) > 0:
+        columns = ["geometry"] + [
+            optional for optional in ["building", "amenity", "building:levels"]
+            if optional in df_buildings
+        ]
+
+        df_buildings = df_buildings[columns].to_crs(df_local.crs)
+        df_buildings["area"] = df_buildings["geometry"].area
+        df_buildings["geometry"] = df_buildings["geometry"].centroid
 
-    df_locations = []
-    for osm_filter in OSM_FILTERS:
-        print("Processing {} ...".format(osm_filter["location_type"]))
-
-        for chunk in context.progress(chunk_ids, total = len(chunk_ids)):
-            osm = pyrosm.OSM("{}/{}.osm.pbf".format(context.path("bavaria.data.osm.chunked"), chunk))
-            
-            try:
-                with warnings.catch_warnings():
-                    warnings.filterwarnings("ignore", category = UserWarning)
-                    warnings.filterwarnings("ignore", category = FutureWarning)
-
-                    df_selection = osm.get_buildings(osm_filter["filter"])
-            except AttributeError:
-                df_selection = None
-            except KeyError:
-                df_selection = None
-
-            if df_selection is not None and len(df_selection) > 0:
-                columns = ["geometry"] + [
-                    optional for optional in ["building", "amenity", "building:levels"]
-                    if optional in df_selection
-                ]
-
-                df_selection = df_selection[columns].to_crs(df_zones.crs)
-                df_selection["area"] = df_selection["geometry"].area
-                df_selection["geometry"] = df_selection["geometry"].centroid
-
-                # Fix area (in one case negative)
-                df_selection["area"] = np.abs(df_selection["area"])
-
-                # Handle number of floors
-                if "building:levels" in columns:
-                    df_selection["floors"] = pd.to_numeric(df_selection["building:levels"], errors = "coerce")
-                    df_selection = df_selection.drop(columns = ["building:levels"])
-                else:
-                    df_selection["floors"] = np.nan
-
-                df_selection["floors"] = df_selection["floors"].fillna(DEFAULT_FLOORS)
-                df_selection["floors"] = np.maximum(df_selection["floors"], 1) # avoid negative
-
-                df_local = df_zones[df_zones["commune_id"] == chunk]
+        # Fix area (in one case negative)
+        df_buildings["area"] = np.abs(df_buildings["area"])
+
+        # Handle number of floors
+        if "building:levels" in columns:
+            df_buildings["floors"] = pd.to_numeric(df_buildings["building:levels"], errors = "coerce")
+            df_buildings = df_buildings.drop(columns = ["building:levels"])
+        else:
+            df_buildings["floors"] = np.nan
+
+        df_buildings["floors"] = df_buildings["floors"].fillna(DEFAULT_FLOORS)
+        df_buildings["floors"] = np.maximum(df_buildings["floors"], 1) # avoid negative
+
+        # Classify the buildings as if they had been read with the individual filters
+        for osm_filter in OSM_FILTERS:
+            df_selection = df_buildings[apply_filter(df_buildings, osm_filter["filter"])].reset_index(drop = True)
+
+            if len(df_selection) > 0:
                 df_selection = gpd.sjoin(df_selection, df_local[["commune_id", "iris_id", "geometry"]])
                 df_selection = df_selection.drop(columns = ["index_right"])
 
                 df_selection["location_type"] = osm_filter["location_type"]
-                df_locations.append(df_selection)
-    
+                df_locations[osm_filter["location_type"]] = df_selection
+
+    return df_locations
+
+def execute(context):
+    df_zones = context.stage("data.spatial.iris")[["geometry", "commune_id", "iris_id"]]
+    chunk_ids = context.stage("bavaria.data.osm.chunked")
+
+    # Each chunk is read once and all filters are applied on the result
+    chunk_locations = []
+
+    with context.progress(label = "Processing OSM chunks ...", total = len(chunk_ids)) as progress:
+        with context.parallel(dict(
+            input_path = context.path("bavaria.data.osm.chunked")
+        )) as parallel:
+            arguments = [(chunk, df_zones[df_zones["commune_id"] == chunk]) for chunk in chunk_ids]
+
+            for df_chunk in parallel.imap(process_chunk, arguments):
+                chunk_locations.append(df_chunk)
+                progress.update()
+
+    # Sort by location type first, as if the chunks had been processed per filter
+    df_locations = [
+        df_chunk[osm_filter["location_type"]]
+        for osm_filter in OSM_FILTERS for df_chunk in chunk_locations
+        if osm_filter["location_type"] in df_chunk
+    ]
+
     df_locations = pd.concat(df_locations)
 
     if not "floors" in df_locations: df_locations["floors"] = np.nan
@@ -1,39 +1,71 @@
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
-import numpy.linalg as la
 
 """
 Generates a distance matrix for the German municipalities.
+
+The result is a compact matrix object with the municipality identifiers, their
+centroid coordinates and the Euclidean distances (in km) as float32 arrays.
+Optionally, the distances are stored in the stage directory and memory-mapped
+when they are used.
 """
 
+BLOCK_SIZE = 1024
+
 def configure(context):
     context.stage("bavaria.data.spatial.iris")
+    context.config("gravity_distance_memmap", False)
+
+def calculate_distances(coordinates, distances):
+    # Row blocks limit the size of the temporary arrays
+    for start in range(0, len(coordinates), BLOCK_SIZE):
+        block = coordinates[start:start + BLOCK_SIZE]
+
+        distances[start:start + BLOCK_SIZE] = 1e-3 * np.hypot(
+            block[:, 0, np.newaxis] - coordinates[np.newaxis, :, 0],
+            block[:, 1, np.newaxis] - coordinates[np.newaxis, :, 1]
+        )
+
+def get_distances(matrix):
+    """
+        Returns the (N, N) distance array of a matrix object.
+    """
+    if matrix["distances"] is None:
+        return np.load(matrix["path"], mmap_mode = "r")
+
+    return matrix["distances"]
+
+def to_long_format(matrix):
+    """
+        Returns the distances as a data frame with one row per pair of municipalities.
+    """
+    identifiers = matrix["identifiers"]
+
+    return pd.DataFrame({ "distance_km": np.asarray(get_distances(matrix)).reshape(-1) }, index = pd.MultiIndex.from_product([
+        identifiers, identifiers
+    ], names = ["origin_id", "destination_id"])).reset_index()
 
 def execute(context):
     # One municipality per "IRIS"
     df_municipalities = context.stage("bavaria.data.spatial.iris")
-    municipalities = df_municipalities["commune_id"].values
-        
-    # Initialize matrix to zero
-    distance_matrix = np.ones((len(municipalities), len(municipalities)))
-    
+    identifiers = np.asarray(df_municipalities["commune_id"].values)
+
     # Convert locations to (N,2)-array
-    locations = np.array([
-        df_municipalities["geometry"].centroid.x,
-        df_municipalities["geometry"].centroid.y
-    ]).T
-    
-    # Calculate Euclidean distances per row
-    for k in range(len(locations)):
-        distance_matrix[k,:] = la.norm(locations[k] - locations, axis = 1)
-    
-    # Convert to km
-    distance_matrix *= 1e-3
-    
-    # Formatting into a data frame
-    df_distances = pd.DataFrame({ "distance_km": distance_matrix.reshape(-1) }, index = pd.MultiIndex.from_product([
-    municipalities, municipalities
-    ], names = ["origin_id", "destination_id"])).reset_index()
-   
-    return df_distances
+    centroids = df_municipalities["geometry"].centroid
+    coordinates = np.vstack([centroids.x.values, centroids.y.values]).T
+
+    # Calculate Euclidean distances in km
+    if context.config("gravity_distance_memmap"):
+        path = "%s/distances.npy" % context.path()
+
+        distances = np.lib.format.open_memmap(path, mode = "w+", dtype = np.float32, shape = (len(identifiers), len(identifiers)))
+        calculate_distances(coordinates, distances)
+        distances.flush()
+
+        return dict(identifiers = identifiers, coordinates = coordinates.astype(np.float32), distances = None, path = path)
+
+    else:
+        distances = np.zeros((len(identifiers), len(identifiers)), dtype = np.float32)
+        calculate_distances(coordinates, distances)
+
+        return dict(identifiers = identifiers, coordinates = coordinates.astype(np.float32), distances = distances, path = None)
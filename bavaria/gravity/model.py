@@ -2,6 +2,9 @@
 import pandas as pd
 import os
 import numpy as np
+import scipy.sparse as sparse
+
+from bavaria.gravity.distance_matrix import get_distances
 
 """
 Apply gravity model to generate a distance matrix for Oberbayern.
@@ -19,61 +22,83 @@ def configure(context):
     context.config("gravity_constant", DEFAULT_CONSTANT)
     context.config("gravity_diagonal", DEFAULT_DIAGONAL)
 
-def evaluate_gravity(population, employees, friction):
+    # Balancing stops if production, attraction and flows change less than the tolerance
+    context.config("gravity_tolerance", 1e-3)
+    context.config("gravity_maximum_iterations", int(1e6))
+
+    # Optionally, only consider pairs of municipalities up to this distance (in km) using a sparse friction matrix
+    context.config("gravity_maximum_distance", None)
+
+def calculate_flow(friction, production, attraction):
+    if sparse.issparse(friction):
+        rows = np.repeat(np.arange(friction.shape[0]), np.diff(friction.indptr))
+        return sparse.csr_matrix((
+            friction.data * production[rows] * attraction[friction.indices],
+            friction.indices, friction.indptr
+        ), shape = friction.shape)
+
+    else:
+        return friction * production[:, np.newaxis] * attraction[np.newaxis, :]
+
+def calculate_flow_delta(flow, previous_flow):
+    if sparse.issparse(flow):
+        return np.max(np.abs(flow.data - previous_flow.data), initial = 0.0)
+
+    else:
+        return np.max(np.abs(flow - previous_flow))
+
+def evaluate_gravity(population, employees, friction, tolerance = 1e-3, maximum_iterations = int(1e6)):
+    """
+        Doubly-constrained (Furness) balancing of a dense or sparse (CSR) friction matrix.
+    """
+    population = np.asarray(population, dtype = float)
+    employees = np.asarray(employees, dtype = float)
+
     # Initizlize production, attraction, and flow
     production = np.ones((len(population),))
     attraction = np.ones((len(population),))
-    flow = np.ones((len(population), len(population)))
+    flow = calculate_flow(friction, production, attraction)
     converged = False
 
-    # Perform maximum 100 iterations (but convergence will hopefully happen earlier)
-    for iteration in range(int(1e6)):
-        # Backup to calculate change
-        previous_production = np.copy(production)
-        previous_attraction = np.copy(attraction)
-        previous_flow = np.copy(flow)
+    # Perform maximum iterations (but convergence will hopefully happen earlier)
+    for iteration in range(maximum_iterations):
+        previous_production = production
+        previous_attraction = attraction
+        previous_flow = flow
 
         # Calculate production terms
-        for k in range(len(population)):
-            production[k] = population[k] / np.sum(attraction * friction[k,:])
+        denominator = friction @ attraction
+        production = np.divide(population, denominator, out = np.zeros_like(population), where = denominator > 0.0)
 
         # Calculate attraction terms
-        for k in range(len(population)):
-            attraction[k] = employees[k] / np.sum(production * friction[:,k])
-
-        # Initialize new flow matrix
-        flow = np.copy(friction)
+        denominator = friction.T @ production
+        attraction = np.divide(employees, denominator, out = np.zeros_like(employees), where = denominator > 0.0)
 
-        # Apply production terms
-        for i in range(len(population)):
-            flow[i,:] *= production[i]
-
-        # Apply attraction terms
-        for j in range(len(population)):
-            flow[:,j] *= attraction[j]
+        # Calculate flows
+        flow = calculate_flow(friction, production, attraction)
 
         # Calculate change to previous iteration
-        production_delta = np.abs(production - previous_production)
-        attraction_delta = np.abs(attraction - previous_attraction)
-        flow_delta = np.abs(flow - previous_flow)
-
-        print("Gravity iteration", iteration, 
-            "prod. max. Δ:", np.max(production_delta),
-            "attr. max. Δ:", np.max(attraction_delta),
-            "flow max. Δ:", np.max(flow_delta),
+        production_delta = np.max(np.abs(production - previous_production))
+        attraction_delta = np.max(np.abs(attraction - previous_attraction))
+        flow_delta = calculate_flow_delta(flow, previous_flow)
+
+        print("Gravity iteration", iteration,
+            "prod. max. Δ:", production_delta,
+            "attr. max. Δ:", attraction_delta,
+            "flow max. Δ:", flow_delta,
         )
 
         # Stop if change is sufficiently small
-        if np.max(production_delta) < 1e-3 and np.max(attraction_delta) < 1e-3 and np.max(flow_delta) < 1e-3:
+        if production_delta < tolerance and attraction_delta < tolerance and flow_delta < tolerance:
             converged = True
             break
-    
+
     assert converged
     return flow
 
 def execute(context):
     # Load data
-    df_distances = context.stage("bavaria.gravity.distance_matrix")
+    distance_matrix = context.stage("bavaria.gravity.distance_matrix")
     df_population = context.stage("bavaria.ipf.attributed")
     df_employees = context.stage("bavaria.data.census.employees")
 
@@ -94,23 +119,16 @@ def execute(context):
     # Find the set of used municipalities (also taking into account zero flows)
     municipalities = set(df_population["origin_id"])
     municipalities |= set(df_employees["destination_id"])
-    municipalities |= set(df_distances["origin_id"])
-    municipalities |= set(df_distances["destination_id"])
+    municipalities |= set(distance_matrix["identifiers"])
     municipalities = sorted(list(municipalities))
-    
+
     # Make sure we have all municipalities in all data sets
     df_population = df_population.set_index("origin_id").reindex(municipalities).fillna(0.0)
     df_employees = df_employees.set_index("destination_id").reindex(municipalities).fillna(0.0)
-    df_distances = df_distances.set_index(["origin_id", "destination_id"]).reindex(pd.MultiIndex.from_product([
-        municipalities, municipalities
-    ]))
-
-    # Transform from a list into a matrix
-    distances = df_distances["distance_km"].values.reshape((len(municipalities), len(municipalities)))
 
     # Run model
-    population = df_population["population"] 
-    employees = df_employees["employees"]
+    population = df_population["population"].values
+    employees = df_employees["employees"].values
 
     # Balancing of the remaining population and workplaces
     observations = min(np.sum(population), np.sum(employees))
@@ -121,16 +139,59 @@ def execute(context):
     slope = context.config("gravity_slope")
     constant = context.config("gravity_constant")
     diagonal = context.config("gravity_diagonal")
+    maximum_distance = context.config("gravity_maximum_distance")
+
+    # Find the municipalities in the distance matrix
+    distances = get_distances(distance_matrix)
+    matrix_indices = pd.Index(distance_matrix["identifiers"]).get_indexer(municipalities)
+    f_matrix = matrix_indices >= 0
+
+    if maximum_distance is None:
+        # Select the dense matrix in the order of the municipalities
+        selected_distances = np.ones((len(municipalities), len(municipalities))) * np.nan
+        selected_distances[np.ix_(f_matrix, f_matrix)] = distances[np.ix_(matrix_indices[f_matrix], matrix_indices[f_matrix])]
+
+        friction = np.exp(slope * selected_distances + constant) + np.eye(len(municipalities)) * diagonal
+
+    else:
+        # Only keep pairs up to the maximum distance, and always the diagonal
+        rows, columns, selected_distances = [np.arange(len(municipalities))], [np.arange(len(municipalities))], [np.zeros((len(municipalities),))]
+        matrix_columns = np.nonzero(f_matrix)[0]
+
+        for row in np.nonzero(f_matrix)[0]:
+            row_distances = distances[matrix_indices[row], matrix_indices[matrix_columns]]
+            f_selected = (row_distances <= maximum_distance) & (matrix_columns != row)
+
+            rows.append(np.ones((np.count_nonzero(f_selected),), dtype = int) * row)
+            columns.append(matrix_columns[f_selected])
+            selected_distances.append(row_distances[f_selected])
+
+        rows, columns, selected_distances = np.concatenate(rows), np.concatenate(columns), np.concatenate(selected_distances)
+
+        friction = np.exp(slope * selected_distances + constant) + (rows == columns) * diagonal
+        friction = sparse.csr_matrix((friction, (rows, columns)), shape = (len(municipalities), len(municipalities)))
+        friction.sort_indices()
 
-    friction = np.exp(slope * distances + constant) + np.eye(len(municipalities)) * diagonal
-    flow = evaluate_gravity(population, employees, friction)
+    flow = evaluate_gravity(population, employees, friction,
+        tolerance = context.config("gravity_tolerance"),
+        maximum_iterations = context.config("gravity_maximum_iterations"))
 
     # Convert to data frame
-    df_matrix = pd.DataFrame({
-        "weight": flow.reshape((-1,)),
-    }, index = pd.MultiIndex.from_product([municipalities, municipalities], names = [
-        "origin_id", "destination_id"
-    ])).reset_index()
+    if sparse.issparse(flow):
+        flow = flow.tocoo()
+
+        df_matrix = pd.DataFrame({
+            "origin_id": np.array(municipalities)[flow.row],
+            "destination_id": np.array(municipalities)[flow.col],
+            "weight": flow.data
+        })
+
+    else:
+        df_matrix = pd.DataFrame({
+            "weight": flow.reshape((-1,)),
+        }, index = pd.MultiIndex.from_product([municipalities, municipalities], names = [
+            "origin_id", "destination_id"
+        ])).reset_index()
 
     # Calculate totals
     df_total = df_matrix[["origin_id", "weight"]].groupby("origin_id").sum().reset_index().rename({ "weight" : "total" }, axis = 1)
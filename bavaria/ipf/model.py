@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
-import itertools
+
+import synthesis.population.ipf as ipf
 
 """
 This stage merge prepared datasets of employees from Kreis level 
@@ -11,6 +12,24 @@ def configure(context):
     context.stage("bavaria.ipf.prepare")
     context.config("bavaria.minimum_age.employment", 16)
  
+def create_constraints(df_model, f_model, model_columns, df_reference, reference_columns):
+    """
+        Groups the selected model cells by the given columns and obtains the target
+        weight of every group from the reference data (zero if not present).
+        Returns the selected model indices, their group codes and the targets.
+    """
+    df_selected = df_model.loc[f_model, model_columns].copy()
+    df_selected.columns = reference_columns
+    df_selected["code"] = df_selected.groupby(reference_columns, observed = True).ngroup()
+
+    df_targets = df_reference.groupby(reference_columns, observed = True)["weight"].sum().reset_index()
+    df_targets = pd.merge(df_selected.drop_duplicates("code"), df_targets, on = reference_columns, how = "left")
+
+    targets = np.zeros((len(df_targets),))
+    targets[df_targets["code"].values] = df_targets["weight"].fillna(0.0).values
+
+    return np.nonzero(f_model)[0], df_selected["code"].values, targets
+
 def execute(context):
     df_population, df_employment, df_licenses_country, df_licenses_kreis = context.stage("bavaria.ipf.prepare")
 
@@ -75,104 +94,59 @@ def execute(context):
     df_model["age_class_employment"] = df_model["combined_age_class"].replace(employment_age_mapping)
     df_model["age_class_license"] = df_model["combined_age_class"].replace(license_age_mapping)
 
-    # Initialize weighting selectors and targets
-    selectors = []
-    targets = []
-    
+    # Initialize constraints, each consisting of disjoint groups of model cells
+    constraints = []
+
     # Population constraints
-    combinations = list(itertools.product(unique_communes, unique_sexes, population_age_classes))
-    for combination in context.progress(combinations, total = len(combinations), label = "Generating population constraints"):    
-        f_reference = df_population["commune_index"] == combination[0]
-        f_reference &= df_population["sex"] == combination[1]
-        f_reference &= df_population["age_class"] == combination[2] 
-    
-        f_model = df_model["commune_index"] == combination[0]
-        f_model &= df_model["sex"] == combination[1]
-        f_model &= df_model["age_class_population"] == combination[2]
-        selectors.append(f_model)
-    
-        target_weight = df_population.loc[f_reference, "weight"].sum()
-        targets.append(target_weight)
-
-    # Employment constraints   
-    combinations = list(itertools.product(unique_departements, unique_sexes, employment_age_classes))
-    for combination in context.progress(combinations, total = len(combinations), label = "Generating employment constraints"):
-        f_reference = df_employment["departement_index"] == combination[0]
-        f_reference &= df_employment["sex"] == combination[1]
-        f_reference &= df_employment["age_class"] == combination[2] 
-    
-        f_model = df_model["departement_index"] == combination[0]
-        f_model &= df_model["sex"] == combination[1]
-        f_model &= df_model["age_class_employment"] == combination[2]
-        f_model &= df_model["employed"] # Only select employed!
-        selectors.append(f_model)
-    
-        target_weight = df_employment.loc[f_reference, "weight"].sum()
-        targets.append(target_weight)
+    constraints.append(create_constraints(
+        df_model, np.ones((len(df_model),), dtype = bool), ["commune_index", "sex", "age_class_population"],
+        df_population, ["commune_index", "sex", "age_class"]))
+
+    # Employment constraints
+    f_model = df_model["departement_index"].isin(unique_departements).values
+    f_model &= df_model["employed"].values # Only select employed!
+
+    constraints.append(create_constraints(
+        df_model, f_model, ["departement_index", "sex", "age_class_employment"],
+        df_employment, ["departement_index", "sex", "age_class"]))
 
     # Minimum employment age
-    f_model = df_model["combined_age_class"] < minimum_employment_age
-    f_model &= df_model["employed"]
-    selectors.append(f_model)
-    targets.append(0.0)
+    f_model = df_model["combined_age_class"].values < minimum_employment_age
+    f_model &= df_model["employed"].values
+    constraints.append((np.nonzero(f_model)[0], np.zeros((np.count_nonzero(f_model),), dtype = int), np.array([0.0])))
 
     # License country constraints
-    combinations = list(itertools.product(unique_sexes, license_age_classes))
-    for combination in context.progress(combinations, total = len(combinations), label = "Generating license constraints"):
-        f_reference = df_licenses_country["sex"] == combination[0]
-        f_reference &= df_licenses_country["age_class"] == combination[1] 
-    
-        f_model = df_model["sex"] == combination[0]
-        f_model &= df_model["age_class_license"] == combination[1]
-        f_model &= df_model["license"] # Only select license owners!
-        selectors.append(f_model)
-    
-        target_weight = df_licenses_country.loc[f_reference, "weight"].sum()
-        targets.append(target_weight)
+    constraints.append(create_constraints(
+        df_model, df_model["license"].values, ["sex", "age_class_license"], # Only select license owners!
+        df_licenses_country, ["sex", "age_class"]))
 
     # License Kreis constraints
-    for departement_index in context.progress(unique_departements, total = len(unique_departements), label = "Generating license constraints per Kreis"):
-        f_reference = df_licenses_kreis["departement_index"] == departement_index
-    
-        f_model = df_model["departement_index"] == departement_index
-        f_model &= df_model["license"] # Only select license owners!
-        selectors.append(f_model)
-    
-        target_weight = df_licenses_kreis.loc[f_reference, "weight"].sum()
-        targets.append(target_weight)
+    f_model = df_model["departement_index"].isin(unique_departements).values
+    f_model &= df_model["license"].values # Only select license owners!
+
+    constraints.append(create_constraints(
+        df_model, f_model, ["departement_index"],
+        df_licenses_kreis, ["departement_index"]))
 
-    # Transform to index-based
-    selectors = [np.nonzero(s.values) for s in selectors]
-    
     # Perform IPF
-    iteration = 0
-    converged = False
     weights = df_model["weight"].values
 
-    while iteration < 1000:
-        iteration_factors = []
-    
-        for f, target_weight in zip(selectors, targets):
-            current_weight = np.sum(weights[f])
-    
-            if current_weight > 0:
-                update_factor = target_weight / current_weight
-                weights[f] *= update_factor
-                iteration_factors.append(update_factor)
-
+    def report(iteration, factors):
         print(
             "Iteration:", iteration,
-            "factors:", len(iteration_factors),
-            "mean:", np.mean(iteration_factors),
-            "min:", np.min(iteration_factors),
-            "max:", np.max(iteration_factors))
-        
-        if np.max(iteration_factors) - 1 < 1e-2:
-            if np.min(iteration_factors) > 1 - 1e-2:
-                converged = True
-                break
-    
-        iteration += 1
+            "factors:", len(factors),
+            "mean:", np.mean(factors),
+            "min:", np.min(factors),
+            "max:", np.max(factors))
+
+    converged, iteration, iteration_factors = ipf.fit(weights, constraints,
+        tolerance = 1e-2, maximum_iterations = 1000, callback = report)
+
+    context.set_info("convergence", dict(
+        converged = converged, iterations = iteration,
+        minimum_factor = float(np.min(iteration_factors)),
+        maximum_factor = float(np.max(iteration_factors))
+    ))
 
     df_model["weight"] = weights
 
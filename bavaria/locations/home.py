@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 
 """
 Yield home location candidates for Germany.
@@ -7,12 +8,17 @@ Yield home location candidates for Germany.
 
 def configure(context):
     context.stage("bavaria.data.buildings")
+    context.stage("bavaria.data.spatial.iris")
 
 def execute(context):
     # Load data
     df = context.stage("bavaria.data.buildings")
     df = df.rename(columns = { "building_id": "home_location_id" })
 
+    # Buildings are given as coordinates
+    df = gpd.GeoDataFrame(df, geometry = gpd.points_from_xy(df["x"], df["y"]),
+        crs = context.stage("bavaria.data.spatial.iris").crs)
+
     return df[[
         "home_location_id", "weight", "commune_id", "iris_id", "geometry",
     ]]
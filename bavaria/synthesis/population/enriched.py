@@ -4,13 +4,13 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 
+import synthesis.population.ipf as ipf
+
 def configure(context):
     delegate.configure(context)
 
-    context.stage("synthesis.population.spatial.home.locations")
-
+    context.stage("bavaria.synthesis.population.zones")
     context.stage("bavaria.data.mid.data")
-    context.stage("bavaria.data.mid.zones")
 
     context.stage("bavaria.data.census.household_size")
     context.stage("bavaria.data.census.household_income")
@@ -23,158 +23,117 @@ def configure(context):
 
     context.config("bavaria.minimum_age.one_person_household", 16)
 
+    # Stop the availability IPF early once all factors are within this tolerance
+    context.config("bavaria.availability_tolerance", 1e-2)
+
 """
 This stage overrides car availability, bike availability and transit subscription based on MiD data
 """
 
-def execute(context):
-    # delegate population
-    df_persons = delegate.execute(context)
-
-    # require home locations
-    df_homes = context.stage("synthesis.population.spatial.home.locations")[["household_id", "geometry"]].copy()
+# Separates the ages of the different sexes when locating the cells of the persons
+AGE_OFFSET = 1000
 
-    # load MiD
-    df_zones = context.stage("bavaria.data.mid.zones")
-    mid = context.stage("bavaria.data.mid.data")
-
-    # assign zone membership to each person
-    f_covered = np.zeros(len(df_homes), dtype = bool)
-    for zone in df_zones["name"].unique():
-        df_query = gpd.sjoin(df_homes, df_zones[df_zones["name"] == zone], predicate = "within")
-        df_homes["inside_{}".format(zone)] = df_homes["household_id"].isin(df_query["household_id"])
-        f_covered |= df_homes["inside_{}".format(zone)]
-
-    df_homes["inside_external"] = ~f_covered
-
-    df_persons = gpd.GeoDataFrame(
-        pd.merge(df_persons, df_homes, on = "household_id"),
-        crs = df_homes.crs
-    )
-
-    # Run IPFs to impute availabilities
-    iterations = 1000
-
-    # CAR AVAILABILITY
-    df_persons["car_availability"] = 1.0
-    constraints = mid["car_availability_constraints"]
-
-    constraints.append({ 
-        "age": (-np.inf, context.config("bavaria.minimum_age.car_availability") - 1), 
-        "target": 0.0 
-    })
-
-    filters = []
-    targets = []
+def create_constraints(df_persons, constraints):
+    result = []
 
     for constraint in constraints:
         f = np.ones((len(df_persons),), dtype = bool)
 
         if "zone" in constraint:
-            f &= df_persons["inside_{}".format(constraint["zone"])]
-        
+            if constraint["zone"].startswith("!"):
+                f &= ~df_persons["inside_{}".format(constraint["zone"][1:])].values
+            else:
+                f &= df_persons["inside_{}".format(constraint["zone"])].values
+
         if "sex" in constraint:
-            f &= df_persons["sex"] == constraint["sex"]
+            f &= (df_persons["sex"] == constraint["sex"]).values
 
         if "age" in constraint:
-            f &= df_persons["age"].between(*constraint["age"])
+            f &= df_persons["age"].between(*constraint["age"]).values
 
-        targets.append(constraint["target"] * np.count_nonzero(f))
-        filters.append(f)
+        result.append(ipf.create_mask_constraint(f, constraint["target"] * np.count_nonzero(f)))
 
-    for iteration in context.progress(range(iterations), label = "imputing car availability"):
-        factors = []
+    return result
 
-        for f, target in zip(filters, targets):
-            current = df_persons.loc[f, "car_availability"].sum()
-            factor = target / current
-            df_persons.loc[f, "car_availability"] *= factor
-            factors.append(factor)
+def create_table(df, cells, column):
+    """
+        Creates a table of weights with one row per cell and one column per category.
+        The cells are returned sorted with their row index as the index.
+    """
+    df_table = df.pivot_table(index = cells, columns = column, values = "weight",
+        aggfunc = "sum", fill_value = 0.0, observed = True)
 
-    print("Factors", "min:", min(factors), "max:", max(factors), "mean:", np.mean(factors))
-    print(df_persons["car_availability"].min(), df_persons["car_availability"].max())
-    
-    # BIKE AVAILABILITY
-    df_persons["bicycle_availability"] = 1.0
-    constraints = mid["bicycle_availability_constraints"]
-
-    constraints.append({ 
-        "age": (-np.inf, context.config("bavaria.minimum_age.bicycle_availability") - 1), 
-        "target": 0.0 
-    })
+    df_cells = df_table.index.to_frame(index = False)
+    return df_cells, np.asarray(df_table.columns.values), df_table.values.astype(float)
 
-    filters = []
-    targets = []
+def sample_categories(random, cell_indices, weights, df_cells):
+    """
+        Samples one category for each given cell from the rows of the weight table.
+    """
+    cdf = np.cumsum(weights, axis = 1)
 
-    for constraint in constraints:
-        f = np.ones((len(df_persons),), dtype = bool)
+    used_indices = np.unique(cell_indices)
+    empty_indices = used_indices[cdf[used_indices, -1] <= 0.0]
 
-        if "zone" in constraint:
-            if constraint["zone"].startswith("!"):
-                f &= ~df_persons["inside_{}".format(constraint["zone"][1:])]
-            else:
-                f &= df_persons["inside_{}".format(constraint["zone"])]
-        
-        if "sex" in constraint:
-            f &= df_persons["sex"] == constraint["sex"]
+    if len(empty_indices) > 0:
+        raise RuntimeError("Cannot sample from cells without weight: {}".format(
+            df_cells.loc[empty_indices].to_dict(orient = "records")))
 
-        if "age" in constraint:
-            f &= df_persons["age"].between(*constraint["age"])
+    cdf[used_indices] /= cdf[used_indices, -1:]
 
-        targets.append(constraint["target"] * np.count_nonzero(f))
-        filters.append(f)
+    u = random.random_sample(len(cell_indices))
+    result = np.zeros((len(cell_indices),), dtype = int)
 
-    for iteration in context.progress(range(iterations), label = "imputing bike availability"):
-        factors = []
+    # The last column of the CDF is one and never exceeded
+    for k in range(weights.shape[1] - 1):
+        result += cdf[cell_indices, k] <= u
 
-        for f, target in zip(filters, targets):
-            current = df_persons.loc[f, "bicycle_availability"].sum()
-            factor = target / current
-            df_persons.loc[f, "bicycle_availability"] *= factor
-            factors.append(factor)
+    return result
 
-    print("Factors", "min:", min(factors), "max:", max(factors), "mean:", np.mean(factors))
+def execute(context):
+    # delegate population
+    df_persons = delegate.execute(context)
 
-    # PT SUBSCRIPTION
-    df_persons["has_pt_subscription"] = 1.0
-    constraints = mid["pt_subscription_constraints"]
+    # require home locations with zone membership
+    df_homes = context.stage("bavaria.synthesis.population.zones")
 
-    constraints.append({ 
-        "age": (-np.inf, context.config("bavaria.minimum_age.pt_subscription") - 1), 
-        "target": 0.0 
-    })
+    # load MiD
+    mid = context.stage("bavaria.data.mid.data")
 
-    filters = []
-    targets = []
+    df_persons = gpd.GeoDataFrame(
+        pd.merge(df_persons, df_homes, on = "household_id"),
+        crs = df_homes.crs
+    )
 
-    for constraint in constraints:
-        f = np.ones((len(df_persons),), dtype = bool)
+    # Run IPFs to impute availabilities, all three are fitted at once on one weight vector
+    iterations = 1000
 
-        if "zone" in constraint:
-            if constraint["zone"].startswith("!"):
-                f &= ~df_persons["inside_{}".format(constraint["zone"][1:])]
-            else:
-                f &= df_persons["inside_{}".format(constraint["zone"])]
-        
-        if "sex" in constraint:
-            f &= df_persons["sex"] == constraint["sex"]
+    weights = np.ones((3 * len(df_persons),))
+    constraints = []
 
-        if "age" in constraint:
-            f &= df_persons["age"].between(*constraint["age"])
+    for index, (name, minimum_age) in enumerate([
+        ("car_availability", context.config("bavaria.minimum_age.car_availability")),
+        ("bicycle_availability", context.config("bavaria.minimum_age.bicycle_availability")),
+        ("pt_subscription", context.config("bavaria.minimum_age.pt_subscription"))
+    ]):
+        for indices, codes, targets in create_constraints(df_persons, mid["{}_constraints".format(name)] + [{
+            "age": (-np.inf, minimum_age - 1),
+            "target": 0.0
+        }]):
+            constraints.append((indices + index * len(df_persons), codes, targets))
 
-        targets.append(constraint["target"] * np.count_nonzero(f))
-        filters.append(f)
+    with context.progress(label = "imputing availabilities", total = iterations) as progress:
+        converged, iteration, factors = ipf.fit(weights, constraints,
+            tolerance = context.config("bavaria.availability_tolerance"), maximum_iterations = iterations,
+            callback = lambda iteration, factors: progress.update())
 
-    for iteration in context.progress(range(iterations), label = "imputing pt subscription"):
-        factors = []
+    print("Factors", "min:", np.min(factors), "max:", np.max(factors), "mean:", np.mean(factors), "iterations:", iteration)
 
-        for f, target in zip(filters, targets):
-            current = df_persons.loc[f, "has_pt_subscription"].sum()
-            factor = target / current
-            df_persons.loc[f, "has_pt_subscription"] *= factor
-            factors.append(factor)
+    df_persons["car_availability"] = weights[:len(df_persons)]
+    df_persons["bicycle_availability"] = weights[len(df_persons):2 * len(df_persons)]
+    df_persons["has_pt_subscription"] = weights[2 * len(df_persons):]
 
-    print("Factors", "min:", min(factors), "max:", max(factors), "mean:", np.mean(factors))
+    print(df_persons["car_availability"].min(), df_persons["car_availability"].max())
 
     # Sample values
     random = np.random.RandomState(context.config("random_seed") + 8572)
@@ -209,27 +168,39 @@ def execute(context):
 
     df_household_size = pd.concat([df_household_size, df_young])
 
-    for (lower_age, upper_age, sex), df in df_household_size.groupby(["lower_age", "upper_age", "sex"]):
-        f = df_persons["age"].between(lower_age, upper_age, inclusive = "left")
-        f &= df_persons["sex"] == sex ## TODO
+    df_cells, categories, weights = create_table(df_household_size, ["sex", "lower_age", "upper_age"], "household_size")
+
+    # Find the age and sex cell of each person, the cells of one sex do not overlap
+    df_cells = df_cells[df_cells["lower_age"] < df_cells["upper_age"]].copy()
+    sexes = list(df_cells["sex"].astype(str).unique())
+
+    offsets = pd.Categorical(df_cells["sex"].astype(str), categories = sexes).codes * AGE_OFFSET
+    df_cells["lower_key"] = df_cells["lower_age"] + offsets
+    df_cells["upper_key"] = df_cells["upper_age"] + offsets
+    df_cells = df_cells.sort_values("lower_key")
+
+    sex_codes = pd.Categorical(df_persons["sex"], categories = sexes).codes
+    person_keys = sex_codes * AGE_OFFSET + df_persons["age"].values
+    cell_indices = np.searchsorted(df_cells["lower_key"].values, person_keys, side = "right") - 1
 
-        df = df.copy()
-        df["weight"] /= df["weight"].sum()
-        df = df.sample(n = np.count_nonzero(f), weights = "weight", replace = True)
-        df_persons.loc[f, "household_size"] = df["household_size"].values
+    f = (sex_codes >= 0) & (cell_indices >= 0)
+    f[f] &= person_keys[f] < df_cells["upper_key"].values[cell_indices[f]]
 
-    df_persons["household_size"] = df_persons["household_size"].astype("category")
+    household_size = df_persons["household_size"].values.astype(object)
+    household_size[f] = categories[sample_categories(random, df_cells.index.values[cell_indices[f]],
+        weights, df_cells[["sex", "lower_age", "upper_age"]])]
+    df_persons["household_size"] = pd.Series(household_size, index = df_persons.index).astype("category")
 
     # Household income (overwrite)
     df_income = context.stage("bavaria.data.census.household_income")
+    df_cells, categories, weights = create_table(df_income, ["household_size"], "income_class")
 
-    for household_size, df in df_income.groupby("household_size"):
-        f = df_persons["household_size"] == household_size
+    cell_indices = pd.Categorical(df_persons["household_size"], categories = df_cells["household_size"].values).codes
+    f = cell_indices >= 0
 
-        df = df.copy()
-        df["weight"] /= df["weight"].sum()
-        df = df.sample(n = np.count_nonzero(f), weights = "weight", replace = True)
-        df_persons.loc[f, "household_income"] = df["income_class"].values
+    household_income = df_persons["household_income"].values.astype(object)
+    household_income[f] = categories[sample_categories(random, cell_indices[f], weights, df_cells)]
+    df_persons["household_income"] = household_income
 
     df_persons["high_income"] = df_persons["household_income"] == "5000+"
 
@@ -0,0 +1,35 @@
+import shapely
+import numpy as np
+
+"""
+This stage assigns the MiD zones to the home locations of the households.
+
+All homes are tested against all zones in one bulk query. The result only depends on
+the home locations, so changes to the availability constraints do not repeat it.
+"""
+
+def configure(context):
+    context.stage("synthesis.population.spatial.home.locations")
+    context.stage("bavaria.data.mid.zones")
+
+def execute(context):
+    df_homes = context.stage("synthesis.population.spatial.home.locations")[["household_id", "geometry"]].copy()
+    df_zones = context.stage("bavaria.data.mid.zones")
+
+    # Find all pairs of homes and zone polygons, the query is run with the polygons to prepare them once
+    tree = shapely.STRtree(df_homes["geometry"].values)
+    zone_indices, home_indices = tree.query(df_zones["geometry"].values, predicate = "contains")
+
+    names = df_zones["name"].values
+    f_covered = np.zeros((len(df_homes),), dtype = bool)
+
+    for zone in df_zones["name"].unique():
+        f = np.zeros((len(df_homes),), dtype = bool)
+        f[home_indices[names[zone_indices] == zone]] = True
+
+        df_homes["inside_{}".format(zone)] = f
+        f_covered |= f
+
+    df_homes["inside_external"] = ~f_covered
+
+    return df_homes
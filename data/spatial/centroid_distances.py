@@ -1,18 +1,49 @@
 import pandas as pd
+import numpy as np
+
+BLOCK_SIZE = 1024
 
 def configure(context):
     context.stage("data.spatial.municipalities")
 
+    # Optionally, only keep pairs of municipalities up to this distance
+    context.config("centroid_distances_maximum_distance", None)
+
 def execute(context):
     df = context.stage("data.spatial.municipalities")
-    records = []
+    maximum_distance = context.config("centroid_distances_maximum_distance")
+
+    identifiers = df["commune_id"].values
+    centroids = df["geometry"].centroid
+    coordinates = np.vstack([centroids.x.values, centroids.y.values]).T
+
+    origin_indices, destination_indices, distances = [], [], []
+
+    with context.progress(total = len(df), label = "Calculating centroid distances ...") as progress:
+        for start in range(0, len(df), BLOCK_SIZE):
+            block = coordinates[start:start + BLOCK_SIZE]
+
+            dx = block[:, 0, np.newaxis] - coordinates[np.newaxis, :, 0]
+            dy = block[:, 1, np.newaxis] - coordinates[np.newaxis, :, 1]
+            block_distances = np.sqrt(dx * dx + dy * dy)
+
+            if maximum_distance is None:
+                block_origins, block_destinations = np.indices(block_distances.shape)
+                block_origins, block_destinations = block_origins.reshape(-1), block_destinations.reshape(-1)
+            else:
+                block_origins, block_destinations = np.nonzero(block_distances <= maximum_distance)
+
+            origin_indices.append(start + block_origins)
+            destination_indices.append(block_destinations)
+            distances.append(block_distances[block_origins, block_destinations])
+
+            progress.update(len(block))
 
-    with context.progress(total = len(df)**2, label = "Calculating centroid distances ...") as progress:
-        for origin_id, origin_geometry in zip(df["commune_id"], df["geometry"]):
-            for destination_id, destination_geometry in zip(df["commune_id"], df["geometry"]):
-                records.append((
-                    origin_id, destination_id, origin_geometry.centroid.distance(destination_geometry.centroid)
-                ))
-                progress.update()
+    origin_indices = np.concatenate(origin_indices)
+    destination_indices = np.concatenate(destination_indices)
 
-    return pd.DataFrame.from_records(records, columns = ["origin_id", "destination_id", "centroid_distance"])
+    return pd.DataFrame({
+        "origin_id": identifiers[origin_indices],
+        "destination_id": identifiers[destination_indices],
+        "centroid_distance": np.concatenate(distances)
+    })
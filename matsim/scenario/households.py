@@ -1,4 +1,4 @@
-import io, gzip
+import os
 
 import numpy as np
 import pandas as pd
@@ -8,6 +8,11 @@ import matsim.writers as writers
 def configure(context):
     context.stage("synthesis.population.enriched")
 
+    context.config("processes")
+    context.config("matsim_compression_level", 9)
+    context.config("matsim_sharded_output", False)
+    context.config("matsim_sharded_byte_identical", False)
+
 # Bavaria: high_income added
 FIELDS = ["household_id", "person_id", "household_income", "high_income", "car_availability", "bicycle_availability", "census_household_id"]
 
@@ -25,6 +30,37 @@ def add_household(writer, household, member_ids):
 
     writer.end_household()
 
+def write_households(writer, progress, df_persons):
+    current_members = []
+    current_household_id = None
+    current_household = None
+
+    for item in df_persons.itertuples(index = False):
+        if current_household_id != item[FIELDS.index("household_id")]:
+            if not current_household_id is None:
+                add_household(writer, current_household, current_members)
+
+            current_household = item
+            current_household_id = item[FIELDS.index("household_id")]
+            current_members = [item[FIELDS.index("person_id")]]
+        else:
+            current_members.append(item[FIELDS.index("person_id")])
+
+        progress.update()
+
+    if not current_household_id is None:
+        add_household(writer, current_household, current_members)
+
+def write_shard(context, arguments):
+    path, df_persons = arguments
+
+    with writers.open_shard(path, context.data("compression_level")) as writer:
+        writer = writers.HouseholdsWriter(writer)
+        writer.start_fragment(writer.HOUSEHOLDS_SCOPE)
+        write_households(writer, context.progress, df_persons)
+
+    return path
+
 def execute(context):
     output_path = "%s/households.xml.gz" % context.path()
 
@@ -32,32 +68,35 @@ def execute(context):
     df_persons = df_persons.sort_values(by = ["household_id", "person_id"])
     df_persons = df_persons[FIELDS]
 
-    current_members = []
-    current_household_id = None
-    current_household = None
+    processes = context.config("processes")
+    compression_level = context.config("matsim_compression_level")
 
-    with gzip.open(output_path, 'wb+') as writer:
-        with io.BufferedWriter(writer, buffer_size = 2 * 1024**3) as writer:
-            writer = writers.HouseholdsWriter(writer)
-            writer.start_households()
+    with writers.ParallelGzipWriter(output_path, processes, compression_level) as output:
+        writer = writers.HouseholdsWriter(output)
+        writer.start_households()
 
-            with context.progress(total = len(df_persons), label = "Writing households ...") as progress:
-                for item in df_persons.itertuples(index = False):
-                    if current_household_id != item[FIELDS.index("household_id")]:
-                        if not current_household_id is None:
-                            add_household(writer, current_household, current_members)
+        with context.progress(total = len(df_persons), label = "Writing households ...") as progress:
+            if context.config("matsim_sharded_output"):
+                # Shards of households are written by the workers and then appended in order
+                byte_identical = context.config("matsim_sharded_byte_identical")
+                extension = "xml" if byte_identical else "xml.gz"
 
-                        current_household = item
-                        current_household_id = item[FIELDS.index("household_id")]
-                        current_members = [item[FIELDS.index("person_id")]]
-                    else:
-                        current_members.append(item[FIELDS.index("person_id")])
+                shards = ((
+                    "%s/households_%d.%s" % (context.path(), index, extension), df_persons.iloc[start:end]
+                ) for index, (start, end) in enumerate(writers.find_shards(df_persons["household_id"].values, processes)))
 
-                    progress.update()
+                with context.parallel(dict(compression_level = None if byte_identical else compression_level)) as parallel:
+                    for path in parallel.imap(write_shard, shards):
+                        if byte_identical:
+                            output.append_uncompressed(path)
+                        else:
+                            output.append(path)
 
-            if not current_household_id is None:
-                add_household(writer, current_household, current_members)
+                        os.remove(path)
+
+            else:
+                write_households(writer, progress, df_persons)
 
-            writer.end_households()
+        writer.end_households()
 
     return "households.xml.gz"
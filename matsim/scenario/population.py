@@ -1,11 +1,10 @@
-import io, gzip
-import itertools
+import os
 
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 
 import matsim.writers as writers
-from matsim.writers import backlog_iterator
 
 def configure(context):
     context.stage("synthesis.population.enriched")
@@ -16,6 +15,13 @@ def configure(context):
     context.stage("synthesis.population.trips")
     context.stage("synthesis.vehicles.vehicles")
 
+    context.config("processes")
+    context.config("matsim_compression_level", 9)
+    context.config("matsim_sharded_output", False)
+
+    # Write uncompressed shards that are compressed by the main process for byte-identical output
+    context.config("matsim_sharded_byte_identical", False)
+
 PERSON_FIELDS = [
     "person_id", "household_income", "car_availability", "bicycle_availability",
     "census_household_id", "census_person_id", "household_id",
@@ -37,70 +43,191 @@ VEHICLE_FIELDS = [
     "owner_id", "vehicle_id", "mode"
 ]
 
-def add_person(writer, person, activities, trips, vehicles):
-    writer.start_person(person[PERSON_FIELDS.index("person_id")])
+# Number of persons that are formatted and written at once
+BLOCK_SIZE = 10000
+
+def find_ranges(person_ids, ids):
+    """
+        Finds for each person the range of consecutive rows in ids that belong to
+        the person. Rows are consumed in order, as they would be by stepping
+        through both tables at the same time.
+    """
+    ids = np.asarray(ids)
+
+    if len(ids) == 0:
+        return np.zeros((len(person_ids),), dtype = int), np.zeros((len(person_ids),), dtype = int)
+
+    run_starts = np.flatnonzero(np.concatenate([[True], ids[1:] != ids[:-1]]))
+    run_ends = np.concatenate([run_starts[1:], [len(ids)]])
+    run_ids = ids[run_starts].tolist()
+
+    starts = np.zeros((len(person_ids),), dtype = int)
+    ends = np.zeros((len(person_ids),), dtype = int)
+
+    run_index = 0
+    position = 0
+
+    for index, person_id in enumerate(person_ids):
+        if run_index < len(run_ids) and run_ids[run_index] == person_id:
+            starts[index] = run_starts[run_index]
+            ends[index] = run_ends[run_index]
+            position = ends[index]
+            run_index += 1
+        else:
+            starts[index] = position
+            ends[index] = position
+
+    return starts, ends
+
+def format_times(values):
+    """
+        Formats times as the writer does, missing times are given as None.
+    """
+    values = np.asarray(values, dtype = float)
+    f_missing = np.isnan(values)
+
+    times = np.where(f_missing, 0, values).astype(np.int64)
+    hours, minutes, seconds = times // 3600, (times % 3600) // 60, times % 60
+
+    return [
+        None if missing else "%02d:%02d:%02d" % item
+        for missing, item in zip(f_missing.tolist(), zip(hours.tolist(), minutes.tolist(), seconds.tolist()))
+    ]
+
+def format_strings(values):
+    return [str(value) for value in values]
+
+def format_persons(df_persons, vehicles):
+    return [
+        '  <person id="%d">\n'
+        '    <attributes>\n'
+        '      <attribute name="householdId" class="java.lang.Integer">%s</attribute>\n'
+        '      <attribute name="householdIncome" class="java.lang.String">%s</attribute>\n'
+        '      <attribute name="highIncome" class="java.lang.Boolean">%s</attribute>\n'
+        '      <attribute name="isMunichResident" class="java.lang.Boolean">%s</attribute>\n'
+        '      <attribute name="carAvailability" class="java.lang.String">%s</attribute>\n'
+        '      <attribute name="bicycleAvailability" class="java.lang.String">%s</attribute>\n'
+        '      <attribute name="censusHouseholdId" class="java.lang.Long">%s</attribute>\n'
+        '      <attribute name="censusPersonId" class="java.lang.Long">%s</attribute>\n'
+        '      <attribute name="htsHouseholdId" class="java.lang.Long">%s</attribute>\n'
+        '      <attribute name="htsPersonId" class="java.lang.Long">%s</attribute>\n'
+        '      <attribute name="hasPtSubscription" class="java.lang.Boolean">%s</attribute>\n'
+        '      <attribute name="hasLicense" class="java.lang.String">%s</attribute>\n'
+        '      <attribute name="age" class="java.lang.Integer">%s</attribute>\n'
+        '      <attribute name="employed" class="java.lang.String">%s</attribute>\n'
+        '      <attribute name="sex" class="java.lang.String">%s</attribute>\n'
+        '      <attribute name="vehicles" class="org.matsim.vehicles.PersonVehicles">{%s}</attribute>\n'
+        '    </attributes>\n'
+        '    <plan selected="yes">\n' % item
+        for item in zip(
+            df_persons["person_id"],
+            format_strings(df_persons["household_id"]),
+            format_strings(df_persons["household_income"]),
+            format_strings(df_persons["high_income"]),
+            format_strings(df_persons["is_munich_resident"]),
+            format_strings(df_persons["car_availability"]),
+            format_strings(df_persons["bicycle_availability"]),
+            format_strings(df_persons["census_household_id"]),
+            format_strings(df_persons["census_person_id"]),
+            format_strings(df_persons["hts_household_id"]),
+            format_strings(df_persons["hts_id"]),
+            format_strings(df_persons["has_pt_subscription"]),
+            ["yes" if value else "no" for value in df_persons["has_license"]],
+            format_strings(df_persons["age"]),
+            format_strings(df_persons["employed"]),
+            [value[0] for value in df_persons["sex"]],
+            vehicles
+        )
+    ]
 
-    writer.start_attributes()
-    writer.add_attribute("householdId", "java.lang.Integer", person[PERSON_FIELDS.index("household_id")])
-    writer.add_attribute("householdIncome", "java.lang.String", person[PERSON_FIELDS.index("household_income")]) # Bavaria updated
-    writer.add_attribute("highIncome", "java.lang.Boolean", person[PERSON_FIELDS.index("high_income")]) # Bavaria added
-    writer.add_attribute("isMunichResident", "java.lang.Boolean", person[PERSON_FIELDS.index("is_munich_resident")]) # Bavaria added
+def format_vehicles(df_vehicles, starts, ends):
+    vehicles = [
+        "\"{mode}\":\"{id}\"".format(mode = mode, id = vehicle_id)
+        for mode, vehicle_id in zip(df_vehicles["mode"], df_vehicles["vehicle_id"])
+    ]
 
-    writer.add_attribute("carAvailability", "java.lang.String", person[PERSON_FIELDS.index("car_availability")])
-    writer.add_attribute("bicycleAvailability", "java.lang.String", person[PERSON_FIELDS.index("bicycle_availability")])
+    return [",".join(vehicles[start:end]) for start, end in zip(starts.tolist(), ends.tolist())]
 
-    writer.add_attribute("censusHouseholdId", "java.lang.Long", person[PERSON_FIELDS.index("census_household_id")])
-    writer.add_attribute("censusPersonId", "java.lang.Long", person[PERSON_FIELDS.index("census_person_id")])
+def format_activities(df_activities, household_ids):
+    geometry = gpd.GeoSeries(df_activities["geometry"].values)
+    x = ["%f" % value for value in geometry.x]
+    y = ["%f" % value for value in geometry.y]
 
-    writer.add_attribute("htsHouseholdId", "java.lang.Long", person[PERSON_FIELDS.index("hts_household_id")])
-    writer.add_attribute("htsPersonId", "java.lang.Long", person[PERSON_FIELDS.index("hts_id")])
+    facilities = [
+        "home_%s" % household_id if purpose == "home" else (None if location_id == -1 else location_id)
+        for purpose, location_id, household_id in zip(df_activities["purpose"], df_activities["location_id"], household_ids)
+    ]
 
-    writer.add_attribute("hasPtSubscription", "java.lang.Boolean", person[PERSON_FIELDS.index("has_pt_subscription")])
-    writer.add_attribute("hasLicense", "java.lang.String", writer.yes_no(person[PERSON_FIELDS.index("has_license")]))
+    facilities = ["" if value is None else 'facility="%s" ' % str(value) for value in facilities]
+    start_times = ["" if value is None else 'start_time="%s" ' % value for value in format_times(df_activities["start_time"])]
+    end_times = ["" if value is None else 'end_time="%s" ' % value for value in format_times(df_activities["end_time"])]
 
-    writer.add_attribute("age", "java.lang.Integer", person[PERSON_FIELDS.index("age")])
-    writer.add_attribute("employed", "java.lang.String", person[PERSON_FIELDS.index("employed")])
-    writer.add_attribute("sex", "java.lang.String", person[PERSON_FIELDS.index("sex")][0])
+    return [
+        '      <activity type="%s" x="%s" y="%s" %s%s%s/>\n' % item
+        for item in zip(df_activities["purpose"], x, y, facilities, start_times, end_times)
+    ]
 
-    writer.add_attribute("vehicles", "org.matsim.vehicles.PersonVehicles", "{{{content}}}".format(content = ",".join([
-        "\"{mode}\":\"{id}\"".format(mode = v[VEHICLE_FIELDS.index("mode")], id = v[VEHICLE_FIELDS.index("vehicle_id")])
-        for v in vehicles
-    ])))
+def format_legs(df_trips):
+    return [
+        '      <leg mode="%s" dep_time="%s" trav_time="%s" >\n'
+        '      <attributes>\n'
+        '        <attribute name="routingMode" class="java.lang.String">%s</attribute>\n'
+        '      </attributes>\n'
+        '      </leg>\n' % (mode, departure_time, travel_time, mode)
+        for mode, departure_time, travel_time in zip(
+            df_trips["mode"], format_times(df_trips["departure_time"]), format_times(df_trips["travel_time"]))
+    ]
 
-    writer.end_attributes()
+def write_persons(writer, progress, df_persons, df_activities, df_trips, df_vehicles):
+    # Find the activities, trips and vehicles of each person
+    person_ids = df_persons["person_id"].tolist()
 
-    writer.start_plan(selected = True)
+    activity_starts, activity_ends = find_ranges(person_ids, df_activities["person_id"].values)
+    trip_starts, trip_ends = find_ranges(person_ids, df_trips["person_id"].values)
+    vehicle_starts, vehicle_ends = find_ranges(person_ids, df_vehicles["owner_id"].values)
 
-    for activity, trip in itertools.zip_longest(activities, trips):
-        start_time = activity[ACTIVITY_FIELDS.index("start_time")]
-        end_time = activity[ACTIVITY_FIELDS.index("end_time")]
-        location_id = activity[ACTIVITY_FIELDS.index("location_id")]
-        geometry = activity[ACTIVITY_FIELDS.index("geometry")]
+    assert np.all(activity_ends > activity_starts)
+    assert np.all(trip_ends - trip_starts == activity_ends - activity_starts - 1)
 
-        if activity[ACTIVITY_FIELDS.index("purpose")] == "home":
-            location_id = "home_%s" % person[PERSON_FIELDS.index("household_id")]
+    # Format all records column-wise, home activities refer to the household of the person
+    activity_counts = activity_ends - activity_starts
+    activity_indices = np.repeat(activity_starts - np.cumsum(activity_counts) + activity_counts, activity_counts) + np.arange(np.sum(activity_counts))
 
-        location = writer.location(
-            geometry.x, geometry.y,
-            None if location_id == -1 else location_id
-        )
+    household_ids = np.full((len(df_activities),), None, dtype = object)
+    household_ids[activity_indices] = np.repeat(np.array(format_strings(df_persons["household_id"]), dtype = object), activity_counts)
 
-        writer.add_activity(
-            type = activity[ACTIVITY_FIELDS.index("purpose")],
-            location = location,
-            start_time = None if np.isnan(start_time) else start_time,
-            end_time = None if np.isnan(end_time) else end_time
-        )
+    activities = format_activities(df_activities, household_ids)
+    legs = format_legs(df_trips)
+    persons = format_persons(df_persons, format_vehicles(df_vehicles, vehicle_starts, vehicle_ends))
+
+    activity_starts, activity_counts, trip_starts = activity_starts.tolist(), activity_counts.tolist(), trip_starts.tolist()
+
+    for block_start in range(0, len(persons), BLOCK_SIZE):
+        block_end = min(block_start + BLOCK_SIZE, len(persons))
+        block = []
+
+        for index in range(block_start, block_end):
+            block.append(persons[index])
+
+            # Activities are interleaved with the legs, the last activity has no leg
+            for offset in range(activity_counts[index]):
+                block.append(activities[activity_starts[index] + offset])
+
+                if offset < activity_counts[index] - 1:
+                    block.append(legs[trip_starts[index] + offset])
+
+            block.append('    </plan>\n  </person>\n')
+
+        writer.write(bytes("".join(block), "utf-8"))
+        progress.update(block_end - block_start)
+
+def write_shard(context, arguments):
+    path, df_persons, df_activities, df_trips, df_vehicles = arguments
 
-        if not trip is None:
-            writer.add_leg(
-                mode = trip[TRIP_FIELDS.index("mode")],
-                departure_time = trip[TRIP_FIELDS.index("departure_time")],
-                travel_time = trip[TRIP_FIELDS.index("travel_time")]
-            )
+    with writers.open_shard(path, context.data("compression_level")) as writer:
+        write_persons(writer, context.progress, df_persons, df_activities, df_trips, df_vehicles)
 
-    writer.end_plan()
-    writer.end_person()
+    return path
 
 def execute(context):
     output_path = "%s/population.xml.gz" % context.path()
@@ -122,60 +249,46 @@ def execute(context):
     df_vehicles = context.stage("synthesis.vehicles.vehicles")[1]
     df_vehicles = df_vehicles.sort_values(by = ["owner_id"])
 
-    with gzip.open(output_path, 'wb+') as writer:
-        with io.BufferedWriter(writer, buffer_size = 2 * 1024**3) as writer:
-            writer = writers.PopulationWriter(writer)
-            writer.start_population()
-
-            activity_iterator = backlog_iterator(iter(df_activities[ACTIVITY_FIELDS].itertuples(index = False)))
-            trip_iterator = backlog_iterator(iter(df_trips[TRIP_FIELDS].itertuples(index = False)))
-            vehicle_iterator = backlog_iterator(iter(df_vehicles[VEHICLE_FIELDS].itertuples(index = False)))
-
-            with context.progress(total = len(df_persons), label = "Writing population ...") as progress:
-                for person in df_persons.itertuples(index = False):
-                    person_id = person[PERSON_FIELDS.index("person_id")]
-
-                    activities = []
-                    trips = []
-                    vehicles = []
-
-                    # Track all activities for person
-                    while activity_iterator.has_next():
-                        activity = activity_iterator.next()
-
-                        if not activity[ACTIVITY_FIELDS.index("person_id")] == person_id:
-                            activity_iterator.previous()
-                            break
-                        else:
-                            activities.append(activity)
-
-                    assert len(activities) > 0
-
-                    # Track all trips for person
-                    while trip_iterator.has_next():
-                        trip = trip_iterator.next()
-
-                        if not trip[TRIP_FIELDS.index("person_id")] == person_id:
-                            trip_iterator.previous()
-                            break
+    processes = context.config("processes")
+    compression_level = context.config("matsim_compression_level")
+
+    with writers.ParallelGzipWriter(output_path, processes, compression_level) as writer:
+        writer.write(b'<?xml version="1.0" encoding="utf-8"?>\n')
+        writer.write(b'<!DOCTYPE population SYSTEM "http://www.matsim.org/files/dtd/population_v6.dtd">\n')
+        writer.write(b'<population>\n')
+
+        with context.progress(total = len(df_persons), label = "Writing population ...") as progress:
+            if context.config("matsim_sharded_output"):
+                # Shards of households are written by the workers and then appended in order
+                person_ids = df_persons["person_id"].tolist()
+
+                activity_starts, activity_ends = find_ranges(person_ids, df_activities["person_id"].values)
+                trip_starts, trip_ends = find_ranges(person_ids, df_trips["person_id"].values)
+                vehicle_starts, vehicle_ends = find_ranges(person_ids, df_vehicles["owner_id"].values)
+
+                byte_identical = context.config("matsim_sharded_byte_identical")
+                extension = "xml" if byte_identical else "xml.gz"
+
+                shards = ((
+                    "%s/population_%d.%s" % (context.path(), index, extension),
+                    df_persons.iloc[start:end],
+                    df_activities.iloc[activity_starts[start]:activity_ends[end - 1]],
+                    df_trips.iloc[trip_starts[start]:trip_ends[end - 1]],
+                    df_vehicles.iloc[vehicle_starts[start]:vehicle_ends[end - 1]]
+                ) for index, (start, end) in enumerate(writers.find_shards(df_persons["household_id"].values, processes)))
+
+                with context.parallel(dict(compression_level = None if byte_identical else compression_level)) as parallel:
+                    for path in parallel.imap(write_shard, shards):
+                        if byte_identical:
+                            writer.append_uncompressed(path)
                         else:
-                            trips.append(trip)
+                            writer.append(path)
 
-                    assert len(trips) == len(activities) - 1
-
-                    # Track all vehicles for person
-                    while vehicle_iterator.has_next():
-                        vehicle = vehicle_iterator.next()
-
-                        if not vehicle[VEHICLE_FIELDS.index("owner_id")] == person_id:
-                            vehicle_iterator.previous()
-                            break
-                        else:
-                            vehicles.append(vehicle)
+                        os.remove(path)
 
-                    add_person(writer, person, activities, trips, vehicles)
-                    progress.update()
+            else:
+                write_persons(writer, progress, df_persons, df_activities, df_trips, df_vehicles)
 
-            writer.end_population()
+        writer.write(b'</population>\n')
 
     return "population.xml.gz"
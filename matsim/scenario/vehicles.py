@@ -1,4 +1,4 @@
-import io, gzip
+import os
 
 import numpy as np
 import pandas as pd
@@ -8,49 +8,88 @@ import matsim.writers as writers
 def configure(context):
     context.stage("synthesis.vehicles.vehicles")
 
+    context.config("processes")
+    context.config("matsim_compression_level", 9)
+    context.config("matsim_sharded_output", False)
+    context.config("matsim_sharded_byte_identical", False)
+
 TYPE_FIELDS = ["type_id", "nb_seats", "length", "width", "pce", "mode"]
 VEHICLE_FIELDS = ["vehicle_id", "type_id", "critair", "technology", "age", "euro"]
 
+def write_vehicles(writer, progress, df_vehicles):
+    for vehicle in df_vehicles.to_dict(orient="records"):
+
+        writer.add_vehicle(
+            vehicle["vehicle_id"],
+            vehicle["type_id"],
+            attributes = {
+                "critair": vehicle["critair"],
+                "technology": vehicle["technology"],
+                "age": vehicle["age"],
+                "euro": vehicle["euro"]
+            }
+        )
+        progress.update()
+
+def write_shard(context, arguments):
+    path, df_vehicles = arguments
+
+    with writers.open_shard(path, context.data("compression_level")) as writer:
+        writer = writers.VehiclesWriter(writer)
+        writer.start_fragment(writer.VEHICLES_SCOPE)
+        write_vehicles(writer, context.progress, df_vehicles)
+
+    return path
+
 def execute(context):
     output_path = "%s/vehicles.xml.gz" % context.path()
 
     df_vehicle_types, df_vehicles = context.stage("synthesis.vehicles.vehicles")
 
-    with gzip.open(output_path, 'wb+') as writer:
-        with io.BufferedWriter(writer, buffer_size = 2 * 1024**3) as writer:
-            writer = writers.VehiclesWriter(writer)
-            writer.start_vehicles()
-
-            with context.progress(total = len(df_vehicle_types), label = "Writing vehicles types ...") as progress:
-                for type in df_vehicle_types.to_dict(orient="records"):
-                    writer.add_type(
-                        type["type_id"],
-                        length=type["length"],
-                        width=type["width"],
-                        engine_attributes = {
-                            "HbefaVehicleCategory": type["hbefa_cat"],
-                            "HbefaTechnology": type["hbefa_tech"],
-                            "HbefaSizeClass": type["hbefa_size"],
-                            "HbefaEmissionsConcept": type["hbefa_emission"]
-                        }
-                    )
-                    progress.update()
-
-            with context.progress(total = len(df_vehicles), label = "Writing vehicles ...") as progress:
-                for vehicle in df_vehicles.to_dict(orient="records"):
-
-                    writer.add_vehicle(
-                        vehicle["vehicle_id"],
-                        vehicle["type_id"],
-                        attributes = {
-                            "critair": vehicle["critair"],
-                            "technology": vehicle["technology"],
-                            "age": vehicle["age"],
-                            "euro": vehicle["euro"]
-                        }
-                    )
-                    progress.update()
-
-            writer.end_vehicles()
+    processes = context.config("processes")
+    compression_level = context.config("matsim_compression_level")
+
+    with writers.ParallelGzipWriter(output_path, processes, compression_level) as output:
+        writer = writers.VehiclesWriter(output)
+        writer.start_vehicles()
+
+        with context.progress(total = len(df_vehicle_types), label = "Writing vehicles types ...") as progress:
+            for type in df_vehicle_types.to_dict(orient="records"):
+                writer.add_type(
+                    type["type_id"],
+                    length=type["length"],
+                    width=type["width"],
+                    engine_attributes = {
+                        "HbefaVehicleCategory": type["hbefa_cat"],
+                        "HbefaTechnology": type["hbefa_tech"],
+                        "HbefaSizeClass": type["hbefa_size"],
+                        "HbefaEmissionsConcept": type["hbefa_emission"]
+                    }
+                )
+                progress.update()
+
+        with context.progress(total = len(df_vehicles), label = "Writing vehicles ...") as progress:
+            if context.config("matsim_sharded_output"):
+                # Shards of vehicles are written by the workers and then appended in order
+                byte_identical = context.config("matsim_sharded_byte_identical")
+                extension = "xml" if byte_identical else "xml.gz"
+
+                shards = ((
+                    "%s/vehicles_%d.%s" % (context.path(), index, extension), df_vehicles.iloc[start:end]
+                ) for index, (start, end) in enumerate(writers.find_shards(np.arange(len(df_vehicles)), processes)))
+
+                with context.parallel(dict(compression_level = None if byte_identical else compression_level)) as parallel:
+                    for path in parallel.imap(write_shard, shards):
+                        if byte_identical:
+                            output.append_uncompressed(path)
+                        else:
+                            output.append(path)
+
+                        os.remove(path)
+
+            else:
+                write_vehicles(writer, progress, df_vehicles)
+
+        writer.end_vehicles()
 
     return "vehicles.xml.gz"
\ No newline at end of file
@@ -1,6 +1,116 @@
 import numpy as np
+import gzip, shutil, collections
+from concurrent.futures import ThreadPoolExecutor
 from xml.sax.saxutils import escape
 
+class ParallelGzipWriter:
+    """
+        Binary file writer that compresses the stream in blocks in a thread pool.
+        Every block is written as a separate gzip member, which standard gzip
+        readers (and MATSim) read as one stream. At most a few blocks per thread
+        are held in memory at any time.
+    """
+    def __init__(self, path, threads = 1, compression_level = 9, block_size = 16 * 1024**2):
+        self.file = open(path, "wb+")
+        self.executor = ThreadPoolExecutor(max_workers = threads)
+        self.compression_level = compression_level
+        self.block_size = block_size
+        self.maximum_pending = 2 * threads
+
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+
+    def write(self, content):
+        self.buffer += content
+
+        if len(self.buffer) >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        if len(self.buffer) > 0:
+            self.pending.append(self.executor.submit(
+                gzip.compress, bytes(self.buffer), self.compression_level, mtime = 0))
+
+            self.buffer = bytearray()
+
+        while len(self.pending) > self.maximum_pending:
+            self.file.write(self.pending.popleft().result())
+
+    def _flush(self):
+        self._submit()
+
+        while len(self.pending) > 0:
+            self.file.write(self.pending.popleft().result())
+
+    def append(self, path):
+        """
+            Appends an existing gzip file, for instance a shard that has been
+            written by another process. Its members are copied as they are, so
+            the output decompresses to the same content as an unsharded one.
+        """
+        self._flush()
+
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, self.file)
+
+    def append_uncompressed(self, path):
+        """
+            Appends the content of an existing uncompressed file. The content passes
+            through the same blocks as written data, so the output is byte-identical
+            to an unsharded one.
+        """
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.block_size), b""):
+                self.write(chunk)
+
+    def close(self):
+        self._flush()
+
+        self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures = True)
+            self.file.close()
+
+# Number of rows that are written per shard at most, unless more processes are available
+SHARD_SIZE = 100000
+
+def find_shards(household_ids, processes):
+    """
+        Splits rows that are sorted by household into contiguous ranges without
+        separating the rows of a household. At least one range per process is
+        created, and more for large inputs so that shards can be appended early.
+    """
+    household_ids = np.asarray(household_ids)
+
+    if len(household_ids) == 0:
+        return []
+
+    count = max(processes, int(np.ceil(len(household_ids) / SHARD_SIZE)))
+
+    boundaries = np.linspace(0, len(household_ids), count + 1).astype(int)[1:-1]
+    boundaries = np.searchsorted(household_ids, household_ids[boundaries], side = "left")
+    boundaries = np.unique(np.concatenate([[0], boundaries, [len(household_ids)]]))
+
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:]) if end > start]
+
+def open_shard(path, compression_level = None):
+    """
+        Opens a shard in a worker process. The shard is a gzip file, unless no
+        compression level is given, in which case it is written uncompressed.
+    """
+    if compression_level is None:
+        return open(path, "wb+")
+
+    return ParallelGzipWriter(path, 1, compression_level)
+
 class XmlWriter:
     def __init__(self, writer):
         self.writer = writer
@@ -17,6 +127,15 @@ class XmlWriter:
     def _write(self, content):
         self.writer.write(bytes(content, "utf-8"))
 
+    def start_fragment(self, scope, indent = 1):
+        """
+            Continues an XML document in the given scope without writing its
+            header, e.g. for a shard that is merged into the final file later.
+        """
+        self._require_scope(None)
+        self.scope = scope
+        self.indent = indent
+
     def _require_scope(self, scope):
         if scope == None and not self.scope is None:
             raise RuntimeError("Execpted initial scope")
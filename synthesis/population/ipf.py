@@ -0,0 +1,55 @@
+import numpy as np
+
+"""
+Shared iterative proportional fitting routine over numeric arrays.
+
+Every constraint is a tuple (indices, codes, targets) or (indices, codes, targets,
+coefficients). The weights at the given indices are grouped by the codes, which must
+be disjoint within one constraint, and every group is scaled such that the sum of
+its weights (multiplied by the coefficients, if given) matches the target. Groups
+that currently have no weight are left unchanged.
+"""
+
+def fit(weights, constraints, tolerance = None, maximum_iterations = 1000, callback = None):
+    """
+        Fits the weights in place. Without tolerance, all iterations are performed,
+        otherwise the fitting stops once all factors of an iteration are within
+        the tolerance around one. Returns whether the fitting converged (None if
+        no tolerance is given), the number of performed iterations and the
+        factors of the last iteration.
+    """
+    factors = np.ones((0,))
+
+    for iteration in range(maximum_iterations):
+        factors = []
+
+        for constraint in constraints:
+            indices, codes, targets = constraint[:3]
+            coefficients = constraint[3] if len(constraint) > 3 else None
+
+            current_weights = weights[indices] if coefficients is None else weights[indices] * coefficients
+            current_weights = np.bincount(codes, current_weights, minlength = len(targets))
+            f_update = current_weights > 0
+
+            update_factors = np.ones((len(targets),))
+            update_factors[f_update] = targets[f_update] / current_weights[f_update]
+
+            weights[indices] *= update_factors[codes]
+            factors.append(update_factors[f_update])
+
+        factors = np.hstack(factors)
+
+        if not callback is None:
+            callback(iteration, factors)
+
+        if not tolerance is None and len(factors) > 0 and np.max(np.abs(factors - 1)) < tolerance:
+            return True, iteration + 1, factors
+
+    return None if tolerance is None else False, maximum_iterations, factors
+
+def create_mask_constraint(f, target):
+    """
+        Creates a constraint that scales the weights selected by a mask to a target.
+    """
+    indices = np.nonzero(f)[0]
+    return indices, np.zeros((len(indices),), dtype = int), np.array([target], dtype = float)
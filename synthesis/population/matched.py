@@ -36,14 +36,50 @@ def configure(context):
     hts = context.config("hts")
     context.stage("data.hts.selected", alias = "hts")
 
+@numba.jit(nopython = True)
+def calculate_cdfs(weights, offsets):
+    # Normalized cumulative weights per cell, cell k covers offsets[k]:offsets[k + 1]
+    cdf = np.zeros(len(weights))
+
+    for k in range(len(offsets) - 1):
+        total = 0.0
+
+        for i in range(offsets[k], offsets[k + 1]):
+            total += weights[i]
+            cdf[i] = total
+
+        for i in range(offsets[k], offsets[k + 1]):
+            cdf[i] /= total
+
+    return cdf
+
 @numba.jit(nopython = True) # Already parallelized parallel = True)
-def sample_indices(uniform, cdf, selected_indices):
-    indices = np.arange(len(uniform))
+def sample_indices(uniform, cdf, starts, ends, selected_indices):
+    indices = np.zeros(len(uniform), dtype = np.int64)
+
+    for i in range(len(uniform)):
+        # Equivalent to np.count_nonzero(cdf < u) within the cell
+        indices[i] = selected_indices[starts[i] + np.searchsorted(cdf[starts[i]:ends[i]], uniform[i])]
+
+    return indices
 
-    for i, u in enumerate(uniform):
-        indices[i] = np.count_nonzero(cdf < u)
+def encode_cells(source_codes, target_codes):
+    # Combines per-column codes into cell codes, -1 if any value is missing
+    source_cells = np.zeros(len(source_codes[0]), dtype = np.int64)
+    target_cells = np.zeros(len(target_codes[0]), dtype = np.int64)
 
-    return selected_indices[indices]
+    for source_column, target_column in zip(source_codes, target_codes):
+        cardinality = max(np.max(source_column, initial = -1), np.max(target_column, initial = -1)) + 1
+
+        codes, uniques = pd.factorize(np.concatenate([
+            source_cells * cardinality + source_column,
+            target_cells * cardinality + target_column
+        ]))
+
+        source_cells = np.where((source_cells >= 0) & (source_column >= 0), codes[:len(source_cells)], -1)
+        target_cells = np.where((target_cells >= 0) & (target_column >= 0), codes[len(source_cells):], -1)
+
+    return source_cells, target_cells
 
 def statistical_matching(progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed = 0, minimum_observations = 0):
     random = np.random.RandomState(random_seed)
@@ -56,64 +92,58 @@ def statistical_matching(progress, df_source, source_identifier, weight, df_targ
     df_source = df_source.sort_values(by = columns)
     df_target = df_target.sort_values(by = columns)
 
-    # Find unique values for all columns
-    unique_values = {}
+    # Encode values of all columns, consistently for source and target
+    source_codes, target_codes = [], []
 
     for column in columns:
-        unique_values[column] = list(sorted(set(df_source[column].unique()) | set(df_target[column].unique())))
-
-    # Generate filters for all columns and values
-    source_filters, target_filters = {}, {}
-
-    for column, column_unique_values in unique_values.items():
-        source_filters[column] = [df_source[column].values == value for value in column_unique_values]
-        target_filters[column] = [df_target[column].values == value for value in column_unique_values]
-
-    # Define search order
-    source_filters = [source_filters[column] for column in columns]
-    target_filters = [target_filters[column] for column in columns]
+        codes, uniques = pd.factorize(pd.concat([df_source[column], df_target[column]], ignore_index = True))
+        source_codes.append(codes[:len(df_source)])
+        target_codes.append(codes[len(df_source):])
 
     # Perform matching
-    weights = df_source[weight].values
+    weights = df_source[weight].values.astype(float)
     assigned_indices = np.ones((len(df_target),), dtype = int) * -1
     unassigned_mask = np.ones((len(df_target),), dtype = bool)
     assigned_levels = np.ones((len(df_target),), dtype = int) * -1
     uniform = random.random_sample(size = (len(df_target),))
 
-    column_indices = [np.arange(len(unique_values[column])) for column in columns]
-
-    for level in range(1, len(column_indices) + 1)[::-1]:
-        level_column_indices = column_indices[:level]
+    for level in range(1, len(columns) + 1)[::-1]:
+        if np.count_nonzero(unassigned_mask) == 0:
+            break
 
-        if np.count_nonzero(unassigned_mask) > 0:
-            for column_index in itertools.product(*level_column_indices):
-                f_source = np.logical_and.reduce([source_filters[i][k] for i, k in enumerate(column_index)])
-                f_target = np.logical_and.reduce([target_filters[i][k] for i, k in enumerate(column_index)] + [unassigned_mask])
+        source_cells, target_cells = encode_cells(source_codes[:level], target_codes[:level])
+        number_of_cells = max(np.max(source_cells, initial = -1), np.max(target_cells, initial = -1)) + 1
 
-                selected_indices = np.nonzero(f_source)[0]
-                requested_samples = np.count_nonzero(f_target)
+        # Group source observations by cell, keeping their order within the cell
+        f_source = source_cells >= 0
+        selected_indices = np.nonzero(f_source)[0]
+        selected_indices = selected_indices[np.argsort(source_cells[f_source], kind = "stable")]
 
-                if requested_samples == 0:
-                    continue
+        counts = np.bincount(source_cells[f_source], minlength = number_of_cells)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        cdf = calculate_cdfs(weights[selected_indices], offsets)
 
-                if len(selected_indices) < minimum_observations:
-                    continue
+        # Find targets in cells with sufficient observations
+        f_cell = (counts >= minimum_observations) & (counts > 0)
+        f_target = unassigned_mask & (target_cells >= 0)
+        f_target[f_target] = f_cell[target_cells[f_target]]
 
-                selected_weights = weights[f_source]
-                cdf = np.cumsum(selected_weights)
-                cdf /= cdf[-1]
+        cells = target_cells[f_target]
 
-                assigned_indices[f_target] = sample_indices(uniform[f_target], cdf, selected_indices)
-                assigned_levels[f_target] = level
-                unassigned_mask[f_target] = False
+        assigned_indices[f_target] = sample_indices(uniform[f_target], cdf, offsets[cells], offsets[cells + 1], selected_indices)
+        assigned_levels[f_target] = level
+        unassigned_mask[f_target] = False
 
-                progress.update(np.count_nonzero(f_target))
+        progress.update(np.count_nonzero(f_target))
 
     # Randomly assign unmatched observations
-    cdf = np.cumsum(weights)
-    cdf /= cdf[-1]
+    cdf = calculate_cdfs(weights, np.array([0, len(weights)]))
 
-    assigned_indices[unassigned_mask] = sample_indices(uniform[unassigned_mask], cdf, np.arange(len(weights)))
+    requested_samples = np.count_nonzero(unassigned_mask)
+    assigned_indices[unassigned_mask] = sample_indices(
+        uniform[unassigned_mask], cdf,
+        np.zeros(requested_samples, dtype = int), np.ones(requested_samples, dtype = int) * len(weights),
+        np.arange(len(weights)))
     assigned_levels[unassigned_mask] = 0
 
     progress.update(np.count_nonzero(unassigned_mask))
@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
 
+import synthesis.population.ipf as ipf
+
 """
 This stage reweights the census data set according to the projection data for a different year.
 """
@@ -85,24 +87,17 @@ def execute(context):
     convergence_threshold = 1e-3
     maximum_iterations = 100
 
-    for iteration in range(maximum_iterations):
-        factors = []    
-        for k in np.arange(len(attributes)):
-            selection = attribute_membership[k]
-        
-            target = attribute_targets[k]
-            current = np.sum(update[selection] * household_weights[selection] * attribute_counts[k])
-        
-            factor = target / current
-            factors.append(factor)
-                
-            update[selection] *= factor
+    # Every attribute is one group over its households, weighted by the household weight and the number of members
+    constraints = [
+        (selection, np.zeros((len(selection),), dtype = int), np.array([target], dtype = float), household_weights[selection] * counts)
+        for selection, target, counts in zip(attribute_membership, attribute_targets, attribute_counts)
+    ]
 
+    def report(iteration, factors):
         print("IPU it={} min={} max={}".format(iteration, np.min(factors), np.max(factors)))
 
-        converged = np.abs(1 - np.max(factors)) < convergence_threshold
-        converged &= np.abs(1 - np.min(factors)) < convergence_threshold
-        if converged: break
+    converged, iteration, factors = ipf.fit(update, constraints,
+        tolerance = convergence_threshold, maximum_iterations = maximum_iterations, callback = report)
 
     # Check that the applied factors in the last iteration are sufficiently small
     assert converged
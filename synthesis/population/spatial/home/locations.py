@@ -10,21 +10,26 @@ def configure(context):
     
     context.config("random_seed")
 
+def _group(codes, count):
+    # Stable ordering of rows by zone code, and the offsets of each zone
+    sorter = np.argsort(codes, kind = "stable")
+    sorter = sorter[codes[sorter] >= 0]
+
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[codes >= 0], minlength = count))])
+    return sorter, offsets
+
 def _sample_locations(context, args):
     # Extract data sets
-    df_locations = context.data("df_locations")
-    df_homes = context.data("df_homes")
+    location_offsets = context.data("location_offsets")
+    location_weights = context.data("location_weights")
+    home_offsets = context.data("home_offsets")
 
     # Extract task parameters
-    iris_id, random_seed = args
-
-    # Select home candidates and locations for the selected IRIS
-    df_homes = df_homes[df_homes["iris_id"] == iris_id].copy()
-    df_locations = df_locations[df_locations["iris_id"] == iris_id].copy()
+    index, random_seed = args
 
     # Verify counts
-    home_count = len(df_homes)
-    location_count = len(df_locations)
+    home_count = home_offsets[index + 1] - home_offsets[index]
+    location_count = location_offsets[index + 1] - location_offsets[index]
 
     assert location_count > 0
     assert home_count > 0
@@ -32,36 +37,51 @@ def _sample_locations(context, args):
     # Perform sampling
     random = np.random.RandomState(random_seed)
 
-    cdf = np.cumsum(df_locations["weight"].values)
+    cdf = np.cumsum(location_weights[location_offsets[index]:location_offsets[index + 1]])
     cdf /= cdf[-1]
 
-    indices = np.array([np.count_nonzero(cdf < u) 
-        for u in random.random_sample(size = home_count)])
-    
-    # Apply selection
-    df_homes["geometry"] = df_locations.iloc[indices]["geometry"].values
-    df_homes["home_location_id"] = df_locations.iloc[indices]["home_location_id"].values
-    
+    indices = np.searchsorted(cdf, random.random_sample(size = home_count), side = "left")
+
     # Update progress
     context.progress.update()
 
-    return gpd.GeoDataFrame(df_homes, crs = df_locations.crs)
+    return location_offsets[index] + indices
 
 def execute(context):
     random = np.random.RandomState(context.config("random_seed"))
 
     df_homes = context.stage("synthesis.population.spatial.home.zones")
     df_locations = context.stage("synthesis.locations.home.locations")
-                   
+
     # Sample locations for home
     unique_iris_ids = sorted(set(df_homes["iris_id"].unique()))
 
+    # Group homes and candidate locations by IRIS
+    iris_index = pd.Index(unique_iris_ids)
+
+    home_sorter, home_offsets = _group(
+        iris_index.get_indexer(np.asarray(df_homes["iris_id"].values)), len(unique_iris_ids))
+
+    location_sorter, location_offsets = _group(
+        iris_index.get_indexer(np.asarray(df_locations["iris_id"].values)), len(unique_iris_ids))
+
     with context.progress(label = "Sampling home locations ...", total = len(unique_iris_ids)):
         with context.parallel(dict(
-            df_locations = df_locations, df_homes = df_homes
+            location_offsets = location_offsets, home_offsets = home_offsets,
+            location_weights = df_locations["weight"].values[location_sorter]
         )) as parallel:
             seeds = random.randint(10000, size = len(unique_iris_ids))
-            df_homes = pd.concat(parallel.map(_sample_locations, zip(unique_iris_ids, seeds)))
+            indices = np.concatenate(parallel.map(_sample_locations, zip(np.arange(len(unique_iris_ids)), seeds)))
+
+    # Apply selection
+    indices = location_sorter[indices]
+
+    df_homes = df_homes.iloc[home_sorter].copy()
+    df_homes["geometry"] = df_locations["geometry"].values[indices]
+    df_homes["home_location_id"] = df_locations["home_location_id"].values[indices]
+
+    df_homes = gpd.GeoDataFrame(df_homes, crs = df_locations.crs)
+
     out = ["household_id", "commune_id", "home_location_id", "geometry"]
         
     return df_homes[out]
@@ -21,59 +21,96 @@ EDUCATION_MAPPING = {
     "high_school": ["C3"],
     "higher_education": ["C4", "C5", "C6"]}
 
-def sample_destination_municipalities(context, arguments):
+BATCH_SIZE = 100
+
+def create_groups(values):
+    """
+        Returns a stable ordering of the values, their unique values and the
+        offsets of each unique value in the ordered values.
+    """
+    codes, unique_values = pd.factorize(values, sort = True)
+    sorter = np.argsort(codes, kind = "stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength = len(unique_values)))])
+    return sorter, pd.Index(unique_values), offsets
+
+def sample_destination_municipalities(context, batch):
     # Load data
-    origin_id, count, random_seed = arguments
-    df_od = context.data("df_od")
+    origin_ids, offsets = context.data("od_origin_ids"), context.data("od_offsets")
+    destination_ids, weights = context.data("od_destination_ids"), context.data("od_weights")
 
-    # Prepare state
-    random = np.random.RandomState(random_seed)
-    df_od = df_od[df_od["origin_id"] == origin_id].copy()
+    df_result = []
+
+    for origin_id, count, random_seed in batch:
+        # Prepare state
+        random = np.random.RandomState(random_seed)
+        index = origin_ids.get_indexer([origin_id])[0]
+        selection = slice(offsets[index], offsets[index + 1]) if index >= 0 else slice(0, 0)
+
+        # Sample destinations
+        counts = random.multinomial(count, weights[selection])
+        f = counts > 0
+
+        df_result.append(pd.DataFrame(dict(
+            origin_id = origin_id,
+            destination_id = destination_ids[selection][f],
+            count = counts[f]
+        )))
 
-    # Sample destinations
-    df_od["count"] = random.multinomial(count, df_od["weight"].values)
-    df_od = df_od[df_od["count"] > 0]
+        context.progress.update()
 
-    context.progress.update()
-    return df_od[["origin_id", "destination_id", "count"]]
+    return pd.concat(df_result)
 
-def sample_locations(context, arguments):
+def sample_locations(context, batch):
     # Load data
-    destination_id, random_seed = arguments
-    df_locations, df_flow = context.data("df_locations"), context.data("df_flow")
+    location_destination_ids, location_offsets = context.data("location_destination_ids"), context.data("location_offsets")
+    location_ids, location_weights = context.data("location_ids"), context.data("location_weights")
+    flow_destination_ids, flow_offsets = context.data("flow_destination_ids"), context.data("flow_offsets")
+    flow_origin_ids, flow_counts = context.data("flow_origin_ids"), context.data("flow_counts")
 
-    # Prepare state
-    random = np.random.RandomState(random_seed)
-    df_locations = df_locations[df_locations["commune_id"] == destination_id]
-    
-    # Determine demand
-    df_flow = df_flow[df_flow["destination_id"] == destination_id]
-    count = df_flow["count"].sum()
+    df_result = []
 
-    # Sample destinations
-    weight = np.ones((len(df_locations),)) / len(df_locations)
+    for destination_id, random_seed in batch:
+        # Prepare state
+        random = np.random.RandomState(random_seed)
 
-    if "weight" in df_locations:
-        weight = df_locations["weight"].values / df_locations["weight"].sum()
-    
-    location_counts = random.multinomial(count, weight)
-    location_ids = df_locations["location_id"].values
-    location_ids = np.repeat(location_ids, location_counts)
+        index = location_destination_ids.get_indexer([destination_id])[0]
+        location_selection = slice(location_offsets[index], location_offsets[index + 1]) if index >= 0 else slice(0, 0)
+
+        # Determine demand
+        index = flow_destination_ids.get_indexer([destination_id])[0]
+        flow_selection = slice(flow_offsets[index], flow_offsets[index + 1])
+        count = flow_counts[flow_selection].sum()
 
-    # Shuffle, as otherwise it is likely that *all* copies 
-    # of the first location id go to the first origin, and so on
-    random.shuffle(location_ids)
+        # Sample destinations
+        number_of_locations = location_selection.stop - location_selection.start
+        weight = np.ones((number_of_locations,)) / number_of_locations
 
-    # Construct a data set for all commutes to this zone
-    origin_id = np.repeat(df_flow["origin_id"].values, df_flow["count"].values)
+        if not location_weights is None:
+            weight = location_weights[location_selection] / location_weights[location_selection].sum()
 
-    df_result = pd.DataFrame.from_records(dict(
-        origin_id = origin_id,
-        location_id = location_ids
-    ))
-    df_result["destination_id"] = destination_id
+        location_counts = random.multinomial(count, weight)
+        selected_location_ids = np.repeat(location_ids[location_selection], location_counts)
 
-    return df_result
+        # Shuffle, as otherwise it is likely that *all* copies
+        # of the first location id go to the first origin, and so on
+        random.shuffle(selected_location_ids)
+
+        # Construct a data set for all commutes to this zone
+        origin_id = np.repeat(flow_origin_ids[flow_selection], flow_counts[flow_selection])
+
+        df_partial = pd.DataFrame.from_records(dict(
+            origin_id = origin_id,
+            location_id = selected_location_ids
+        ))
+        df_partial["destination_id"] = destination_id
+
+        df_result.append(df_partial)
+
+    return pd.concat(df_result)
+
+def create_batches(items):
+    items = list(items)
+    return [items[k:k + BATCH_SIZE] for k in range(0, len(items), BATCH_SIZE)]
 
 def process(context, purpose, random, df_persons, df_od, df_locations,step_name):
     df_persons = df_persons[df_persons["has_%s_trip" % purpose]]
@@ -84,11 +121,18 @@ def process(context, purpose, random, df_persons, df_od, df_locations,step_name)
     df_demand = df_demand[["commune_id", "count", "random_seed"]]
     df_demand = df_demand[df_demand["count"] > 0]
 
+    # Group OD pairs by origin
+    sorter, origin_ids, offsets = create_groups(df_od["origin_id"].values)
+
     df_flow = []
 
     with context.progress(label = "Sampling %s municipalities" % step_name, total = len(df_demand)) as progress:
-        with context.parallel(dict(df_od = df_od)) as parallel:
-            for df_partial in parallel.imap_unordered(sample_destination_municipalities, df_demand.itertuples(index = False, name = None)):
+        with context.parallel(dict(
+            od_origin_ids = origin_ids, od_offsets = offsets,
+            od_destination_ids = df_od["destination_id"].values[sorter],
+            od_weights = df_od["weight"].values[sorter]
+        )) as parallel:
+            for df_partial in parallel.imap_unordered(sample_destination_municipalities, create_batches(df_demand.itertuples(index = False, name = None))):
                 df_flow.append(df_partial)
 
     df_flow = pd.concat(df_flow).sort_values(["origin_id", "destination_id"])
@@ -97,11 +141,22 @@ def process(context, purpose, random, df_persons, df_od, df_locations,step_name)
     unique_ids = df_flow["destination_id"].unique()
     random_seeds = random.randint(0, int(1e6), len(unique_ids))
 
+    # Group locations and flows by destination
+    location_sorter, location_destination_ids, location_offsets = create_groups(df_locations["commune_id"].values)
+    flow_sorter, flow_destination_ids, flow_offsets = create_groups(df_flow["destination_id"].values)
+
     df_result = []
 
     with context.progress(label = "Sampling %s destinations" % purpose, total = len(df_demand)) as progress:
-        with context.parallel(dict(df_locations = df_locations, df_flow = df_flow)) as parallel:
-            for df_partial in parallel.imap_unordered(sample_locations, zip(unique_ids, random_seeds)):
+        with context.parallel(dict(
+            location_destination_ids = location_destination_ids, location_offsets = location_offsets,
+            location_ids = df_locations["location_id"].values[location_sorter],
+            location_weights = df_locations["weight"].values[location_sorter] if "weight" in df_locations else None,
+            flow_destination_ids = flow_destination_ids, flow_offsets = flow_offsets,
+            flow_origin_ids = df_flow["origin_id"].values[flow_sorter],
+            flow_counts = df_flow["count"].values[flow_sorter]
+        )) as parallel:
+            for df_partial in parallel.imap_unordered(sample_locations, create_batches(zip(unique_ids, random_seeds))):
                 df_result.append(df_partial)
 
     df_result = pd.concat(df_result).sort_values(["origin_id", "destination_id"])
@@ -1,6 +1,7 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import numba
 from .candidates import EDUCATION_MAPPING
 
 def configure(context):
@@ -12,35 +13,274 @@ def configure(context):
 
     context.config("education_location_source", "bpe")
 
+    # With a positive tolerance (in meters), the first candidate matching the commute distance up to this tolerance is chosen instead of the best one
+    context.config("primary_location_tolerance", 0.0)
+
+
+@numba.jit(nopython = True)
+def scan_cell(cell_index, x, y, commute_distance, best_cost, selected_index, cell_bounds, cell_offsets, cell_counts,
+        cell_coordinates, cell_candidates, margin):
+    """
+        Updates the best candidate with the alive locations of a cell, unless the lower
+        bound of the cost in the cell shows that it cannot contain a better candidate.
+    """
+    if cell_counts[cell_index] == 0:
+        return best_cost, selected_index
+
+    x0, y0, x1, y1 = cell_bounds[cell_index, 0], cell_bounds[cell_index, 1], cell_bounds[cell_index, 2], cell_bounds[cell_index, 3]
+
+    dx = max(x0 - x, 0.0, x - x1)
+    dy = max(y0 - y, 0.0, y - y1)
+    minimum_distance = np.sqrt(dx * dx + dy * dy)
+
+    dx = max(abs(x - x0), abs(x - x1))
+    dy = max(abs(y - y0), abs(y - y1))
+    maximum_distance = np.sqrt(dx * dx + dy * dy)
+
+    if max(0.0, minimum_distance - commute_distance, commute_distance - maximum_distance) - margin > best_cost:
+        return best_cost, selected_index
+
+    for position in range(cell_offsets[cell_index], cell_offsets[cell_index] + cell_counts[cell_index]):
+        dx = cell_coordinates[position, 0] - x
+        dy = cell_coordinates[position, 1] - y
+        cost = abs(np.sqrt(dx * dx + dy * dy) - commute_distance)
+        candidate_index = cell_candidates[position]
+
+        if cost < best_cost or (cost == best_cost and candidate_index < selected_index):
+            best_cost = cost
+            selected_index = candidate_index
+
+    return best_cost, selected_index
+
+@numba.jit(nopython = True)
+def scan_ring(ring, home_i, home_j, grid_shape, x, y, commute_distance, best_cost, selected_index,
+        cell_bounds, cell_offsets, cell_counts, cell_coordinates, cell_candidates, margin):
+    """
+        Scans all grid cells at the given Chebyshev distance (in cells) from the home cell.
+    """
+    nx, ny = grid_shape[0], grid_shape[1]
+
+    # Upper and lower rows of the ring, the single home cell for the first ring
+    for j in (home_j - ring, home_j + ring):
+        if 0 <= j < ny:
+            for i in range(max(home_i - ring, 0), min(home_i + ring, nx - 1) + 1):
+                best_cost, selected_index = scan_cell(i * ny + j, x, y, commute_distance, best_cost, selected_index,
+                    cell_bounds, cell_offsets, cell_counts, cell_coordinates, cell_candidates, margin)
+
+        if ring == 0:
+            return best_cost, selected_index
+
+    # Left and right columns of the ring
+    for i in (home_i - ring, home_i + ring):
+        if 0 <= i < nx:
+            for j in range(max(home_j - ring + 1, 0), min(home_j + ring - 1, ny - 1) + 1):
+                best_cost, selected_index = scan_cell(i * ny + j, x, y, commute_distance, best_cost, selected_index,
+                    cell_bounds, cell_offsets, cell_counts, cell_coordinates, cell_candidates, margin)
+
+    return best_cost, selected_index
+
+@numba.jit(nopython = True)
+def find_distance_ordering(home_coordinates, commute_distances, location_coordinates, location_offsets, location_candidates,
+        candidate_locations, nan_candidates, grid_origin, grid_size, grid_shape, cell_bounds, cell_offsets, cell_locations, tolerance):
+    """
+        Greedy assignment of candidates to persons in the given order: each person
+        obtains the available candidate that minimizes |distance from home - commute
+        distance|, with ties resolved by the lowest candidate index. Candidates are
+        grouped by location, and locations by square grid cells. For every person,
+        the rings of cells around the home cell are visited outwards and inwards
+        starting from the ring at the commute distance, and the search in each
+        direction stops once the rings cannot contain a better candidate. With a
+        positive tolerance, the search stops as soon as a candidate within that
+        tolerance is found.
+    """
+    number_of_candidates = len(location_candidates)
+    number_of_locations = len(location_offsets) - 1
+    number_of_cells = len(cell_offsets) - 1
+    nx, ny = grid_shape[0], grid_shape[1]
+
+    indices = np.zeros((len(commute_distances),), dtype = np.int64)
+    f_available = np.ones((number_of_candidates,), dtype = np.bool_)
+
+    # Next available candidate per location
+    location_pointers = location_offsets[:-1].copy()
+
+    # Alive locations are kept at the front of each cell, with their coordinates and next candidate
+    cell_counts = np.diff(cell_offsets)
+    cell_locations = cell_locations.copy()
+    cell_coordinates = location_coordinates[cell_locations]
+    cell_candidates = location_candidates[location_pointers[cell_locations]]
+    location_positions = np.zeros((number_of_locations,), dtype = np.int64)
+
+    for cell_index in range(number_of_cells):
+        for k in range(cell_offsets[cell_index], cell_offsets[cell_index + 1]):
+            location_positions[cell_locations[k]] = k
+
+    location_cells = np.ones((number_of_locations,), dtype = np.int64) * -1
+
+    for cell_index in range(number_of_cells):
+        for k in range(cell_offsets[cell_index], cell_offsets[cell_index + 1]):
+            location_cells[cell_locations[k]] = cell_index
+
+    # Candidates without coordinates have a NaN cost and are always selected first
+    nan_pointer = 0
+    first_pointer = 0
+
+    margin = 1e-3
+
+    for person_index in range(len(commute_distances)):
+        x, y = home_coordinates[person_index, 0], home_coordinates[person_index, 1]
+        commute_distance = commute_distances[person_index]
+
+        while nan_pointer < len(nan_candidates) and not f_available[nan_candidates[nan_pointer]]:
+            nan_pointer += 1
+
+        while first_pointer < number_of_candidates and not f_available[first_pointer]:
+            first_pointer += 1
+
+        if np.isnan(x) or np.isnan(y) or np.isnan(commute_distance):
+            selected_index = first_pointer # All costs are NaN
+
+        elif nan_pointer < len(nan_candidates):
+            selected_index = nan_candidates[nan_pointer]
+
+        else:
+            best_cost = np.inf
+            selected_index = -1
+
+            # Home cell, which may lie outside of the grid
+            home_i = int(np.floor((x - grid_origin[0]) / grid_size))
+            home_j = int(np.floor((y - grid_origin[1]) / grid_size))
+
+            # Range of rings that overlap with the grid
+            first_ring = max(0, -home_i, home_i - nx + 1, -home_j, home_j - ny + 1)
+            last_ring = max(home_i, nx - 1 - home_i, home_j, ny - 1 - home_j)
+
+            outer_ring = int(min(max(commute_distance / grid_size, first_ring), last_ring))
+            inner_ring = outer_ring - 1
+
+            while outer_ring <= last_ring or inner_ring >= first_ring:
+                if outer_ring <= last_ring:
+                    # Distances in outer rings only grow, so the search stops at the first ring that is too far
+                    if max(outer_ring - 1, 0) * grid_size - commute_distance - margin > best_cost:
+                        outer_ring = last_ring + 1
+                    else:
+                        best_cost, selected_index = scan_ring(outer_ring, home_i, home_j, grid_shape, x, y, commute_distance,
+                            best_cost, selected_index, cell_bounds, cell_offsets, cell_counts, cell_coordinates, cell_candidates, margin)
+                        outer_ring += 1
+
+                if inner_ring >= first_ring:
+                    # Distances in inner rings only shrink, so the search stops at the first ring that is too close
+                    if commute_distance - (inner_ring + 1) * grid_size * np.sqrt(2.0) - margin > best_cost:
+                        inner_ring = first_ring - 1
+                    else:
+                        best_cost, selected_index = scan_ring(inner_ring, home_i, home_j, grid_shape, x, y, commute_distance,
+                            best_cost, selected_index, cell_bounds, cell_offsets, cell_counts, cell_coordinates, cell_candidates, margin)
+                        inner_ring -= 1
+
+                if best_cost <= tolerance and tolerance > 0.0:
+                    break
+
+        # Remove the selected candidate
+        indices[person_index] = selected_index
+        f_available[selected_index] = False
+
+        # Candidates of a location are always consumed in ascending order
+        location_index = candidate_locations[selected_index]
+        location_pointers[location_index] += 1
+
+        if location_cells[location_index] < 0:
+            continue # Location without coordinates
+
+        position = location_positions[location_index]
+
+        if location_pointers[location_index] < location_offsets[location_index + 1]:
+            cell_candidates[position] = location_candidates[location_pointers[location_index]]
+
+        else:
+            # Location is exhausted, swap it behind the alive locations of its cell
+            cell_index = location_cells[location_index]
+            last_position = cell_offsets[cell_index] + cell_counts[cell_index] - 1
 
-def define_distance_ordering(df_persons, df_candidates, progress):
-    indices = []
+            other_location = cell_locations[last_position]
+            cell_locations[position], cell_locations[last_position] = other_location, location_index
+            location_positions[other_location], location_positions[location_index] = position, last_position
 
-    f_available = np.ones((len(df_candidates),), dtype = bool)
-    costs = np.ones((len(df_candidates),)) * np.inf
+            cell_coordinates[position, 0], cell_coordinates[last_position, 0] = cell_coordinates[last_position, 0], cell_coordinates[position, 0]
+            cell_coordinates[position, 1], cell_coordinates[last_position, 1] = cell_coordinates[last_position, 1], cell_coordinates[position, 1]
+            cell_candidates[position], cell_candidates[last_position] = cell_candidates[last_position], cell_candidates[position]
+
+            cell_counts[cell_index] -= 1
+
+    return indices
+
+def define_distance_ordering(df_persons, df_candidates, progress, tolerance = 0.0):
+    home_locations = gpd.GeoSeries(df_persons["home_location"].values)
+    home_coordinates = np.vstack([home_locations.x.values, home_locations.y.values]).T
+    commute_distances = df_persons["commute_distance"].values.astype(float)
 
     commute_coordinates = np.vstack([
         df_candidates["geometry"].x.values,
         df_candidates["geometry"].y.values
     ]).T
 
-    for home_coordinate, commute_distance in zip(df_persons["home_location"], df_persons["commute_distance"]):
-        home_coordinate = np.array([home_coordinate.x, home_coordinate.y])
-        distances = np.sqrt(np.sum((commute_coordinates[f_available] - home_coordinate)**2, axis = 1))
-        costs[f_available] = np.abs(distances - commute_distance)
+    # Group candidates by location, ascending by index per location
+    location_coordinates, candidate_locations = np.unique(commute_coordinates, axis = 0, return_inverse = True)
+    candidate_locations = candidate_locations.reshape(-1)
 
-        selected_index = np.argmin(costs)
-        indices.append(selected_index)
-        f_available[selected_index] = False
-        costs[selected_index] = np.inf
+    location_candidates = np.argsort(candidate_locations, kind = "stable")
+    location_offsets = np.concatenate([[0], np.cumsum(np.bincount(candidate_locations, minlength = len(location_coordinates)))])
+
+    f_nan = np.any(np.isnan(location_coordinates), axis = 1)
+    nan_candidates = np.nonzero(f_nan[candidate_locations])[0]
+
+    # Group locations with coordinates into square grid cells, about 32 locations per cell
+    grid_locations = np.nonzero(~f_nan)[0]
+    grid_coordinates = location_coordinates[grid_locations]
+    target_cells = max(1.0, len(grid_locations) / 32)
+
+    if len(grid_locations) > 0:
+        grid_origin = np.min(grid_coordinates, axis = 0)
+        extent = np.max(grid_coordinates, axis = 0) - grid_origin
+
+        grid_size = max(np.sqrt(extent[0] * extent[1] / target_cells), np.max(extent) / target_cells, 1e-6)
+        grid_shape = (extent / grid_size).astype(np.int64) + 1
+
+        grid_indices = np.minimum(np.floor((grid_coordinates - grid_origin) / grid_size).astype(np.int64), grid_shape - 1)
+        location_grid_cells = grid_indices[:, 0] * grid_shape[1] + grid_indices[:, 1]
+    else:
+        grid_origin, grid_size, grid_shape = np.zeros((2,)), 1.0, np.ones((2,), dtype = np.int64)
+        location_grid_cells = np.zeros((0,), dtype = np.int64)
+
+    number_of_cells = grid_shape[0] * grid_shape[1]
+
+    sorter = np.argsort(location_grid_cells, kind = "stable")
+    cell_locations = grid_locations[sorter]
+    cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(location_grid_cells, minlength = number_of_cells))])
+
+    # Tight bounds of the locations per cell
+    cell_bounds = np.zeros((number_of_cells, 4))
+    cell_bounds[:, :2] = np.inf
+    cell_bounds[:, 2:] = -np.inf
+
+    np.minimum.at(cell_bounds[:, 0], location_grid_cells, grid_coordinates[:, 0])
+    np.minimum.at(cell_bounds[:, 1], location_grid_cells, grid_coordinates[:, 1])
+    np.maximum.at(cell_bounds[:, 2], location_grid_cells, grid_coordinates[:, 0])
+    np.maximum.at(cell_bounds[:, 3], location_grid_cells, grid_coordinates[:, 1])
+
+    indices = find_distance_ordering(
+        home_coordinates, commute_distances,
+        location_coordinates, location_offsets.astype(np.int64), location_candidates.astype(np.int64),
+        candidate_locations.astype(np.int64), nan_candidates.astype(np.int64),
+        grid_origin.astype(float), float(grid_size), grid_shape.astype(np.int64),
+        cell_bounds, cell_offsets.astype(np.int64), cell_locations.astype(np.int64), float(tolerance))
 
-        progress.update()
+    progress.update(len(df_persons))
 
     assert len(set(indices)) == len(df_candidates)
 
     return indices
 
-def define_random_ordering(df_persons, df_candidates, progress):
+def define_random_ordering(df_persons, df_candidates, progress, tolerance = 0.0):
     progress.update(len(df_candidates))
     return np.arange(len(df_candidates))
 
@@ -59,7 +299,7 @@ def process_municipality(context, origin_id):
     # From previous step, this should be equal!
     assert len(df_persons) == len(df_candidates)
 
-    indices = define_ordering(df_persons, df_candidates, context.progress)
+    indices = define_ordering(df_persons, df_candidates, context.progress, context.data("tolerance"))
     df_candidates = df_candidates.iloc[indices]
 
     df_candidates["person_id"] = df_persons["person_id"].values
@@ -73,7 +313,10 @@ def process(context, purpose, df_persons, df_candidates):
     df_result = []
 
     with context.progress(label = "Distributing %s destinations" % purpose, total = len(df_persons)) as progress:
-        with context.parallel(dict(df_persons = df_persons, df_candidates = df_candidates)) as parallel:
+        with context.parallel(dict(
+            df_persons = df_persons, df_candidates = df_candidates,
+            tolerance = context.config("primary_location_tolerance")
+        )) as parallel:
             for df_partial in parallel.imap_unordered(process_municipality, unique_ids):
                 df_result.append(df_partial)
 
@@ -0,0 +1,466 @@
+"""
+This module provides a batch version of the secondary location assignment. Instead
+of solving every chain on its own, problems of the same shape (chain, left tail,
+right tail, free chain) and size are stacked into arrays and sampling, relaxation,
+discretization and evaluation are performed for all of them at once.
+
+The logic follows closely the one of the sequential components in `rda` and
+`components`, but since random numbers are consumed in a different order, the
+results are not identical to the sequential solver (only statistically).
+"""
+
+import numpy as np
+
+from synthesis.population.spatial.secondary.rda import run_gravity_simulation, calculate_feasibilities
+from synthesis.population.spatial.secondary.components import prepare_distance_tables
+
+KINDS = np.array(["free", "left_tail", "right_tail", "chain"])
+
+def create_batches(problems, maximum_size = None):
+    """
+        Groups the assignment problems (as obtained from
+        `problems.extract_assignment_problems`) by kind and size and stacks their
+        information into arrays. Each batch keeps track of the positions of its
+        problems in the input.
+    """
+    kinds = KINDS[problems["has_origin"] * 2 + problems["has_destination"]]
+    sizes = problems["sizes"]
+    trip_counts = np.diff(problems["trip_offsets"])
+
+    batches = []
+
+    for kind, size, trips in sorted(set(zip(kinds, sizes, trip_counts))):
+        indices = np.nonzero((kinds == kind) & (sizes == size) & (trip_counts == trips))[0]
+
+        if maximum_size is None:
+            chunks = [indices]
+        else:
+            chunks = np.array_split(indices, int(np.ceil(len(indices) / maximum_size)))
+
+        for chunk in chunks:
+            activities = problems["offsets"][chunk][:, np.newaxis] + np.arange(size)
+            trip_selection = problems["trip_offsets"][chunk][:, np.newaxis] + np.arange(trips)
+
+            purposes = problems["purposes"][activities]
+
+            # Purposes as they are paired with the trips in the sequential distance sampler
+            trip_purposes = np.empty((len(chunk), trips), dtype = object)
+            trip_purposes[:, :min(size, trips)] = purposes[:, :min(size, trips)]
+
+            batches.append(dict(
+                kind = kind, size = size, trips = trips, indices = chunk,
+                activities = activities,
+                purposes = purposes,
+                trip_purposes = trip_purposes,
+                modes = problems["modes"][trip_selection],
+                travel_times = problems["travel_times"][trip_selection],
+                origin = None if kind in ("free", "left_tail") else problems["origins"][chunk],
+                destination = None if kind in ("free", "right_tail") else problems["destinations"][chunk],
+            ))
+
+    return batches
+
+def select_batch(batch, selection):
+    """
+        Returns a view on a subset of the problems of a batch.
+    """
+    partial = dict(batch)
+
+    for field in ("indices", "activities", "purposes", "trip_purposes", "modes", "travel_times", "origin", "destination"):
+        if not batch[field] is None:
+            partial[field] = batch[field][selection]
+
+    return partial
+
+class BatchDistanceSampler:
+    def __init__(self, random, distributions, maximum_iterations = 1000, leisure_correction_factor = 1.0):
+        self.random = random
+        self.distributions = distributions
+        self.tables = prepare_distance_tables(distributions)
+        self.maximum_iterations = maximum_iterations
+        self.leisure_correction_factor = leisure_correction_factor
+
+    def sample_distances(self, batch):
+        modes, travel_times, trip_purposes = batch["modes"], batch["travel_times"], batch["trip_purposes"]
+        distances = np.zeros(modes.shape)
+
+        # Only trips that are paired with a variable purpose obtain a distance (see CustomDistanceSampler)
+        f_sampled = trip_purposes != None
+
+        for mode, table in self.tables.items():
+            f_mode = f_sampled & (modes == mode)
+            count = np.count_nonzero(f_mode)
+
+            if count == 0:
+                continue
+
+            # Equivalent to np.count_nonzero(travel_time > bounds) per trip
+            bound_indices = np.searchsorted(table["bounds"], travel_times[f_mode], side = "left")
+
+            u = self.random.random_sample(count)
+            values = np.zeros((count,))
+
+            for bound_index in np.unique(bound_indices):
+                start, end = table["offsets"][bound_index], table["offsets"][bound_index + 1]
+                f_bound = bound_indices == bound_index
+
+                # Equivalent to np.count_nonzero(u > cdf) per trip
+                values[f_bound] = table["values"][start + np.searchsorted(table["cdf"][start:end], u[f_bound], side = "left")]
+
+            distances[f_mode] = values
+
+        distances[trip_purposes == "leisure"] *= self.leisure_correction_factor
+        return distances
+
+    def sample(self, batch):
+        count = len(batch["indices"])
+
+        if batch["kind"] != "chain":
+            return np.ones((count,), dtype = bool), self.sample_distances(batch)
+
+        direct_distances = np.sqrt(np.sum((batch["destination"] - batch["origin"])**2, axis = 1))
+
+        best_distances = np.zeros((count, batch["trips"]))
+        best_deltas = np.ones((count,)) * np.inf
+
+        # One point and two trips
+        f_round_trip = (direct_distances < 1e-3) & (batch["size"] == 1)
+
+        if np.any(f_round_trip):
+            distances = self.sample_distances(select_batch(batch, f_round_trip))
+            best_distances[f_round_trip] = distances[:, [0, 0]]
+            best_deltas[f_round_trip] = 0.0
+
+        # General case: Rejection sampling for all remaining chains in parallel
+        pending = np.nonzero(~f_round_trip)[0]
+
+        for iteration in range(self.maximum_iterations):
+            if len(pending) == 0:
+                break
+
+            distances = self.sample_distances(select_batch(batch, pending))
+            deltas = calculate_feasibilities(distances, direct_distances[pending])
+
+            f_improved = deltas < best_deltas[pending]
+            best_deltas[pending[f_improved]] = deltas[f_improved]
+            best_distances[pending[f_improved]] = distances[f_improved]
+
+            pending = pending[best_deltas[pending] > 0.0]
+
+        return best_deltas == 0.0, best_distances
+
+def sample_tails(random, anchors, distances):
+    """
+        Vectorized version of `rda.sample_tail` for (N, 2) anchors and (N, T) distances.
+    """
+    angles = random.random_sample(distances.shape) * 2.0 * np.pi
+    offsets = np.stack([np.cos(angles), np.sin(angles)], axis = 2) * distances[:, :, np.newaxis]
+
+    locations = np.concatenate([anchors[:, np.newaxis, :], offsets], axis = 1)
+    return np.cumsum(locations, axis = 1)[:, 1:]
+
+class BatchRelaxationSolver:
+    def __init__(self, random, chain_solver, index):
+        self.random = random
+        self.index = index
+
+        self.alpha = chain_solver.alpha
+        self.eps = chain_solver.eps
+        self.maximum_iterations = chain_solver.maximum_iterations
+        self.lateral_deviation = chain_solver.lateral_deviation
+
+    def solve(self, batch, distances):
+        if batch["kind"] == "chain":
+            return self.solve_chains(batch, distances)
+
+        elif batch["kind"] == "free":
+            return self.solve_free(batch, distances)
+
+        else:
+            return self.solve_tails(batch, distances)
+
+    def solve_free(self, batch, distances):
+        count = len(batch["indices"])
+        anchors = np.zeros((count, 2))
+
+        for purpose in np.unique(batch["purposes"][:, 0]):
+            f_purpose = batch["purposes"][:, 0] == purpose
+
+            candidates = self.index.data[purpose]["locations"]
+            anchors[f_purpose] = candidates[self.random.randint(0, len(candidates), size = np.count_nonzero(f_purpose))]
+
+        locations = np.concatenate([anchors[:, np.newaxis, :], sample_tails(self.random, anchors, distances)], axis = 1)
+        return np.ones((count,), dtype = bool), locations
+
+    def solve_tails(self, batch, distances):
+        count = len(batch["indices"])
+
+        if batch["kind"] == "left_tail":
+            locations = sample_tails(self.random, batch["destination"], distances)
+        else:
+            locations = sample_tails(self.random, batch["origin"], distances)[:, ::-1, :]
+
+        return np.ones((count,), dtype = bool), locations
+
+    def prepare_directions(self, batch):
+        count = len(batch["indices"])
+        origin, destination = batch["origin"], batch["destination"]
+
+        direct_distances = np.sqrt(np.sum((destination - origin)**2, axis = 1))
+        directions = np.zeros((count, 2))
+
+        # We have a zero direct distance, choose a direction randomly
+        f_zero = direct_distances < 1e-12
+        angles = self.random.random_sample(np.count_nonzero(f_zero)) * np.pi * 2.0
+        directions[f_zero] = np.vstack([np.cos(angles), np.sin(angles)]).T
+
+        directions[~f_zero] = (destination[~f_zero] - origin[~f_zero]) / direct_distances[~f_zero, np.newaxis]
+        normals = np.vstack([directions[:, 1], -directions[:, 0]]).T
+
+        return direct_distances, directions, normals
+
+    def solve_chains(self, batch, distances):
+        direct_distances, directions, normals = self.prepare_directions(batch)
+
+        if batch["size"] == 1:
+            return self.solve_two_points(batch, distances, direct_distances, directions, normals)
+
+        count = len(batch["indices"])
+        origin, destination = batch["origin"], batch["destination"]
+
+        # Prepare initial locations
+        total_distances = np.sum(distances, axis = 1)
+        shares = np.cumsum(distances[:, :-1], axis = 1) / np.where(total_distances < 1e-12, 1.0, total_distances)[:, np.newaxis]
+        shares[total_distances < 1e-12] = np.linspace(0, 1, batch["trips"] - 1)
+
+        locations = origin[:, np.newaxis, :] + directions[:, np.newaxis, :] * shares[:, :, np.newaxis] * direct_distances[:, np.newaxis, np.newaxis]
+        locations = np.concatenate([origin[:, np.newaxis, :], locations, destination[:, np.newaxis, :]], axis = 1)
+
+        # Infeasible chains keep their initial locations
+        valid = np.zeros((count,), dtype = bool)
+        active = np.nonzero(calculate_feasibilities(distances, direct_distances) == 0.0)[0]
+
+        # Add lateral deviations
+        if self.lateral_deviation is None:
+            lateral_deviations = np.maximum(direct_distances[active], 1.0)
+        else:
+            lateral_deviations = np.ones((len(active),)) * self.lateral_deviation
+
+        deviations = 2.0 * (self.random.normal(size = (len(active), batch["size"])) - 0.5) * lateral_deviations[:, np.newaxis]
+        locations[active, 1:-1] += normals[active, np.newaxis, :] * deviations[:, :, np.newaxis]
+
+        # Run gravity simulation for all active chains
+        packed_locations = np.ascontiguousarray(locations[active]).reshape(-1, 2)
+        packed_distances = np.ascontiguousarray(distances[active]).reshape(-1)
+        offsets = np.arange(len(active) + 1) * batch["trips"]
+
+        active_valid = np.zeros((len(active),), dtype = bool)
+        iterations = np.zeros((len(active),), dtype = np.int64)
+
+        run_gravity_simulation(
+            packed_locations, packed_distances, offsets,
+            self.alpha, self.eps, self.maximum_iterations, active_valid, iterations)
+
+        locations[active] = packed_locations.reshape(len(active), batch["trips"] + 1, 2)
+        valid[active] = active_valid
+
+        return valid, locations[:, 1:-1]
+
+    def solve_two_points(self, batch, distances, direct_distances, directions, normals):
+        count = len(batch["indices"])
+        origin = batch["origin"]
+
+        total_distances = np.sum(distances, axis = 1)
+        ratios = np.ones((count,))
+        f_ratio = (distances[:, 0] > 0.0) | (distances[:, 1] > 0.0)
+        ratios[f_ratio] = distances[f_ratio, 0] / total_distances[f_ratio]
+
+        locations = np.zeros((count, 2))
+        valid = np.zeros((count,), dtype = bool)
+
+        # Zero direct distance
+        f_zero = direct_distances == 0.0
+        locations[f_zero] = origin[f_zero] + directions[f_zero] * distances[f_zero, 0][:, np.newaxis]
+        valid[f_zero] = distances[f_zero, 0] == distances[f_zero, 1]
+
+        # Direct distance too long
+        f_long = ~f_zero & (direct_distances > total_distances)
+        locations[f_long] = origin[f_long] + directions[f_long] * (ratios[f_long] * direct_distances[f_long])[:, np.newaxis]
+
+        # Direct distance too short
+        f_short = ~f_zero & ~f_long & (direct_distances < np.abs(distances[:, 0] - distances[:, 1]))
+        maximum_distances = np.max(distances, axis = 1)
+        locations[f_short] = origin[f_short] + directions[f_short] * (ratios[f_short] * maximum_distances[f_short])[:, np.newaxis]
+
+        # Regular case: Intersection of two circles
+        f_regular = ~f_zero & ~f_long & ~f_short
+        d0, d1, D = distances[f_regular, 0], distances[f_regular, 1], direct_distances[f_regular]
+
+        A = 0.5 * (d0**2 - d1**2 + D**2) / D
+        H = np.sqrt(np.maximum(0, d0**2 - A**2))
+        signs = np.where(self.random.random_sample(np.count_nonzero(f_regular)) < 0.5, 1.0, -1.0)
+
+        centers = origin[f_regular] + directions[f_regular] * A[:, np.newaxis]
+        locations[f_regular] = centers + (signs * H)[:, np.newaxis] * normals[f_regular]
+        valid[f_regular] = True
+
+        return valid, locations[:, np.newaxis, :]
+
+class BatchDiscretizationSolver:
+    def __init__(self, index, thresholds = None, candidates = 1):
+        self.index = index
+        self.thresholds = thresholds
+        self.candidates = candidates
+
+    def solve(self, batch, locations, distances = None):
+        purposes = batch["purposes"]
+        k = 1 if distances is None or self.thresholds is None else self.candidates
+
+        # Query all locations with the same purpose at once
+        candidate_identifiers = np.empty(purposes.shape + (k,), dtype = object)
+        candidate_locations = np.zeros(purposes.shape + (k, 2))
+        candidate_counts = np.zeros(purposes.shape, dtype = int)
+
+        for purpose in np.unique(purposes):
+            f_purpose = purposes == purpose
+            identifiers, purpose_locations = self.index.query_many(purpose, locations[f_purpose], k)
+
+            count = identifiers.shape[1]
+            candidate_counts[f_purpose] = count
+
+            candidate_identifiers[f_purpose, :count] = identifiers
+            candidate_locations[f_purpose, :count] = purpose_locations
+
+        if k == 1:
+            selection = np.zeros(purposes.shape, dtype = int)
+        else:
+            selection = self.select_candidates(batch, candidate_locations, candidate_counts, distances)
+
+        identifiers = np.take_along_axis(candidate_identifiers, selection[:, :, np.newaxis], axis = 2)[:, :, 0]
+        discretized_locations = np.take_along_axis(candidate_locations, selection[:, :, np.newaxis, np.newaxis], axis = 2)[:, :, 0]
+
+        return identifiers, discretized_locations
+
+    def select_candidates(self, batch, candidate_locations, candidate_counts, distances):
+        # See CustomDiscretizationSolver.select_candidates
+        count, size, k = candidate_locations.shape[:3]
+        selection = np.zeros((count, size), dtype = int)
+
+        thresholds = np.zeros(batch["modes"].shape)
+
+        for mode, threshold in self.thresholds.items():
+            thresholds[batch["modes"] == mode] = threshold
+
+        has_origin = not batch["origin"] is None
+        previous_locations = batch["origin"] if has_origin else None
+
+        for index in range(size):
+            errors = np.zeros((count, k))
+            trip_indices = []
+
+            if not previous_locations is None:
+                trip_indices.append((index if has_origin else index - 1, previous_locations))
+
+            if index == size - 1 and not batch["destination"] is None:
+                trip_indices.append((index + 1 if has_origin else index, batch["destination"]))
+
+            for trip_index, references in trip_indices:
+                trip_errors = np.sqrt(np.sum((candidate_locations[:, index] - references[:, np.newaxis, :])**2, axis = 2))
+                trip_errors = np.abs(trip_errors - distances[:, trip_index, np.newaxis]) - thresholds[:, trip_index, np.newaxis]
+                errors = np.maximum(errors, trip_errors)
+
+            # Ignore padding if there are less candidates than requested
+            errors[np.arange(k)[np.newaxis, :] >= candidate_counts[:, index, np.newaxis]] = np.inf
+
+            selection[:, index] = np.argmin(errors, axis = 1)
+            previous_locations = candidate_locations[np.arange(count), index, selection[:, index]]
+
+        return selection
+
+class BatchDiscretizationErrorObjective:
+    def __init__(self, thresholds):
+        self.thresholds = thresholds
+
+    def evaluate(self, batch, distances, locations):
+        count = len(batch["indices"])
+        chain = [locations]
+
+        if not batch["origin"] is None: chain.insert(0, batch["origin"][:, np.newaxis, :])
+        if not batch["destination"] is None: chain.append(batch["destination"][:, np.newaxis, :])
+
+        chain = np.concatenate(chain, axis = 1)
+        discretized_distances = np.sqrt(np.sum((chain[:, :-1] - chain[:, 1:])**2, axis = 2))
+
+        thresholds = np.zeros(batch["modes"].shape)
+
+        for mode, threshold in self.thresholds.items():
+            thresholds[batch["modes"] == mode] = threshold
+
+        excess_errors = np.abs(distances - discretized_distances) - thresholds
+        return np.maximum(0.0, np.max(excess_errors, axis = 1))
+
+class BatchAssignmentSolver:
+    def __init__(self, distance_sampler, relaxation_solver, discretization_solver, objective, maximum_iterations = 1000, batch_size = None):
+        self.maximum_iterations = maximum_iterations
+        self.batch_size = batch_size
+
+        self.distance_sampler = distance_sampler
+        self.relaxation_solver = relaxation_solver
+        self.discretization_solver = discretization_solver
+        self.objective = objective
+
+    def solve_batch(self, batch):
+        count = len(batch["indices"])
+
+        best_objectives = np.ones((count,)) * np.inf
+        best_valid = np.zeros((count,), dtype = bool)
+        best_identifiers = np.empty((count, batch["size"]), dtype = object)
+        best_locations = np.zeros((count, batch["size"], 2))
+
+        has_result = np.zeros((count,), dtype = bool)
+        pending = np.arange(count)
+
+        for assignment_iteration in range(self.maximum_iterations):
+            if len(pending) == 0:
+                break
+
+            partial = select_batch(batch, pending)
+
+            distance_valid, distances = self.distance_sampler.sample(partial)
+            relaxation_valid, locations = self.relaxation_solver.solve(partial, distances)
+            identifiers, discretized_locations = self.discretization_solver.solve(partial, locations, distances)
+
+            objectives = self.objective.evaluate(partial, distances, discretized_locations)
+            valid = (objectives == 0.0) & distance_valid & relaxation_valid
+
+            f_update = ~has_result[pending] | (objectives < best_objectives[pending])
+            selection = pending[f_update]
+
+            has_result[selection] = True
+            best_objectives[selection] = objectives[f_update]
+            best_valid[selection] = valid[f_update]
+            best_identifiers[selection] = identifiers[f_update]
+            best_locations[selection] = discretized_locations[f_update]
+
+            pending = pending[~best_valid[pending]]
+
+        return dict(valid = best_valid, identifiers = best_identifiers, locations = best_locations)
+
+    def solve(self, problems):
+        """
+            Solves the assignment problems (as obtained from
+            `problems.extract_assignment_problems`) and returns validity per
+            problem and identifiers and locations per variable activity.
+        """
+        valid = np.zeros((len(problems["sizes"]),), dtype = bool)
+        identifiers = np.empty((len(problems["purposes"]),), dtype = object)
+        locations = np.zeros((len(problems["purposes"]), 2))
+
+        for batch in create_batches(problems, self.batch_size):
+            batch_result = self.solve_batch(batch)
+
+            valid[batch["indices"]] = batch_result["valid"]
+            identifiers[batch["activities"]] = batch_result["identifiers"]
+            locations[batch["activities"]] = batch_result["locations"]
+
+        return dict(valid = valid, identifiers = identifiers, locations = locations)
@@ -1,41 +1,86 @@
 import synthesis.population.spatial.secondary.rda as rda
 import sklearn.neighbors
+import joblib
 import numpy as np
+import numpy.linalg as la
+
+def prepare_distance_tables(distributions):
+    """
+        Concatenates the per-band distance distributions of every mode into
+        contiguous arrays. The entries of band b are found in the range
+        offsets[b]:offsets[b + 1] of `cdf` and `values`.
+    """
+    tables = {}
+
+    for mode, mode_distribution in distributions.items():
+        bands = mode_distribution["distributions"]
+
+        tables[mode] = dict(
+            bounds = np.asarray(mode_distribution["bounds"]),
+            offsets = np.cumsum([0] + [len(band["cdf"]) for band in bands]),
+            cdf = np.concatenate([band["cdf"] for band in bands]),
+            values = np.concatenate([band["values"] for band in bands])
+        )
+
+    return tables
 
 class CustomDistanceSampler(rda.FeasibleDistanceSampler):
-    def __init__(self, random, distributions, maximum_iterations = 1000, leisure_correction_factor = 1.0):
-        rda.FeasibleDistanceSampler.__init__(self, random = random, maximum_iterations = maximum_iterations)
+    def __init__(self, random, distributions, maximum_iterations = 1000, leisure_correction_factor = 1.0, maximum_block_size = 64):
+        rda.FeasibleDistanceSampler.__init__(self, random = random, maximum_iterations = maximum_iterations, maximum_block_size = maximum_block_size)
 
         self.random = random
         self.distributions = distributions
+        self.tables = prepare_distance_tables(distributions)
         self.leisure_correction_factor = leisure_correction_factor
 
     def sample_distances(self, problem):
-        distances = np.zeros((len(problem["modes"])))
+        return self.sample_distance_block(problem, 1)[0]
+
+    def sample_distance_block(self, problem, count):
+        # Only trips that are paired with a variable purpose obtain a distance
+        trips = list(zip(problem["modes"], problem["travel_times"], problem["purposes"]))
 
-        for index, (mode, travel_time, purpose) in enumerate(zip(problem["modes"], problem["travel_times"], problem["purposes"])):
-            mode_distribution = self.distributions[mode]
+        distances = np.zeros((count, len(problem["modes"])))
+        u = self.random.random_sample((count, len(trips)))
 
-            bound_index = np.count_nonzero(travel_time > mode_distribution["bounds"])
-            mode_distribution = mode_distribution["distributions"][bound_index]
+        for index, (mode, travel_time, purpose) in enumerate(trips):
+            table = self.tables[mode]
 
-            distances[index] = mode_distribution["values"][
-                np.count_nonzero(self.random.random_sample() > mode_distribution["cdf"])
+            # Equivalent to np.count_nonzero(travel_time > bounds)
+            band_index = np.searchsorted(table["bounds"], travel_time, side = "left")
+            start, end = table["offsets"][band_index], table["offsets"][band_index + 1]
+
+            # Equivalent to np.count_nonzero(u > cdf)
+            distances[:, index] = table["values"][
+                start + np.searchsorted(table["cdf"][start:end], u[:, index], side = "left")
             ]
 
             if purpose == "leisure":
-                distances[index] *= self.leisure_correction_factor
+                distances[:, index] *= self.leisure_correction_factor
 
         return distances
 
 class CandidateIndex:
-    def __init__(self, data):
+    def __init__(self, data, indices = None):
         self.data = data
-        self.indices = {}
+        self.indices = indices
+
+        if indices is None:
+            self.indices = {}
+
+            for purpose, data in self.data.items():
+                print("Constructing spatial index for %s ..." % purpose)
+                self.indices[purpose] = sklearn.neighbors.KDTree(data["locations"])
 
-        for purpose, data in self.data.items():
-            print("Constructing spatial index for %s ..." % purpose)
-            self.indices[purpose] = sklearn.neighbors.KDTree(data["locations"])
+    def save(self, path):
+        joblib.dump(dict(data = self.data, indices = self.indices), path)
+
+    @staticmethod
+    def load(path):
+        # Arrays (including those of the trees) are memory-mapped read-only, so
+        # that all processes share the same pages instead of holding copies
+        content = joblib.load(path, mmap_mode = "r")
+        return CandidateIndex(content["data"], content["indices"])
 
     def query(self, purpose, location):
         index = self.indices[purpose].query(location.reshape(1, -1), return_distance = False)[0][0]
@@ -43,6 +88,15 @@ class CandidateIndex:
         location = self.data[purpose]["locations"][index]
         return identifier, location
 
+    def query_many(self, purpose, locations, k = 1):
+        # Returns the k nearest candidates (ordered by distance) for a (N, 2) array of locations
+        k = min(k, len(self.data[purpose]["locations"]))
+        indices = self.indices[purpose].query(locations.reshape(-1, 2), k = k, return_distance = False)
+
+        identifiers = self.data[purpose]["identifiers"][indices]
+        locations = self.data[purpose]["locations"][indices]
+        return identifiers, locations
+
     def sample(self, purpose, random):
         index = random.randint(0, len(self.data[purpose]["locations"]))
         identifier = self.data[purpose]["identifiers"][index]
@@ -50,18 +104,39 @@ class CandidateIndex:
         return identifier, location
 
 class CustomDiscretizationSolver(rda.DiscretizationSolver):
-    def __init__(self, index):
+    def __init__(self, index, thresholds = None, candidates = 1):
         self.index = index
+        self.thresholds = thresholds
+        self.candidates = candidates
+
+    def solve(self, problem, locations, distances = None):
+        purposes = np.array(problem["purposes"], dtype = object)
+
+        # Query all locations of the same purpose at once
+        candidate_identifiers, candidate_locations = [None] * len(purposes), [None] * len(purposes)
+        k = 1 if distances is None or self.thresholds is None else self.candidates
 
-    def solve(self, problem, locations):
-        discretized_locations = []
-        discretized_identifiers = []
+        for purpose in set(problem["purposes"]):
+            indices = np.nonzero(purposes == purpose)[0]
+            identifiers, purpose_locations = self.index.query_many(purpose, locations[indices], k)
 
-        for location, purpose in zip(locations, problem["purposes"]):
-            identifier, location = self.index.query(purpose, location.reshape(1, -1))
+            for index, identifier, location in zip(indices, identifiers, purpose_locations):
+                candidate_identifiers[index] = identifier
+                candidate_locations[index] = location
 
-            discretized_identifiers.append(identifier)
-            discretized_locations.append(location)
+        # Either take the nearest point or the candidate with lowest discretization error
+        if k == 1:
+            selection = [0] * len(purposes)
+        else:
+            selection = self.select_candidates(problem, candidate_locations, distances)
+
+        discretized_identifiers = [
+            identifiers[index] for identifiers, index in zip(candidate_identifiers, selection)
+        ]
+
+        discretized_locations = [
+            locations[index] for locations, index in zip(candidate_locations, selection)
+        ]
 
         assert len(discretized_locations) == problem["size"]
 
@@ -69,6 +144,34 @@ class CustomDiscretizationSolver(rda.DiscretizationSolver):
             valid = True, locations = np.vstack(discretized_locations), identifiers = discretized_identifiers
         )
 
+    def select_candidates(self, problem, candidate_locations, distances):
+        # Greedily choose along the chain the candidate that minimizes the excess error of
+        # the incoming trip (and the outgoing trip for the last activity if it is fixed)
+        selection = []
+
+        has_origin = not problem["origin"] is None
+        previous_location = problem["origin"][0] if has_origin else None
+
+        for index, locations in enumerate(candidate_locations):
+            errors = np.zeros((len(locations),))
+            trip_indices = []
+
+            if not previous_location is None:
+                trip_indices.append((index if has_origin else index - 1, previous_location))
+
+            if index == problem["size"] - 1 and not problem["destination"] is None:
+                trip_indices.append((index + 1 if has_origin else index, problem["destination"][0]))
+
+            for trip_index, reference in trip_indices:
+                trip_errors = np.abs(la.norm(locations - reference, axis = 1) - distances[trip_index])
+                trip_errors -= self.thresholds[problem["modes"][trip_index]]
+                errors = np.maximum(errors, trip_errors)
+
+            selection.append(np.argmin(errors))
+            previous_location = locations[selection[-1]]
+
+        return selection
+
 class CustomFreeChainSolver(rda.RelaxationSolver):
     def __init__(self, random, index):
         self.random = random
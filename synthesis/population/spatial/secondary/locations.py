@@ -1,10 +1,11 @@
 import numpy as np
 import pandas as pd
 import multiprocessing as mp
+import os
 import shapely.geometry as geo
 import geopandas as gpd
 
-from synthesis.population.spatial.secondary.problems import find_assignment_problems
+from synthesis.population.spatial.secondary.problems import find_assignment_problems, extract_assignment_problems
 
 def configure(context):
     context.stage("synthesis.population.trips")
@@ -21,6 +22,19 @@ def configure(context):
 
     context.config("secloc_maximum_iterations", np.inf)
 
+    # Either solve the assignment problems one by one ("sequential") or in vectorized batches ("batch")
+    solver = context.config("secloc_solver", "sequential")
+    context.config("secloc_batch_size", 10000)
+
+    if not solver in ("sequential", "batch"):
+        raise RuntimeError("Unknown secondary location solver (only 'sequential' and 'batch' are supported): %s" % solver)
+
+    # Split the persons into work units of approximately this number of trips instead of one unit per process
+    context.config("secloc_chunk_size", None)
+
+    # Number of nearest candidates among which the one with lowest discretization error is chosen
+    context.config("secloc_discretization_candidates", 1)
+
     DEFAULT_LEISURE_CORRECTION_FACTOR = 2.0
     context.config("leisure_correction_factor", DEFAULT_LEISURE_CORRECTION_FACTOR)
 
@@ -75,6 +89,7 @@ def resample_distributions(distributions, factors):
 
 from synthesis.population.spatial.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver, AngularTailSolver, GeneralRelaxationSolver
 from synthesis.population.spatial.secondary.components import CustomDistanceSampler, CustomDiscretizationSolver, CandidateIndex, CustomFreeChainSolver
+from synthesis.population.spatial.secondary.batch import BatchAssignmentSolver, BatchDistanceSampler, BatchRelaxationSolver, BatchDiscretizationSolver, BatchDiscretizationErrorObjective
 
 def execute(context):
     # Load trips and primary locations
@@ -86,6 +101,10 @@ def execute(context):
     distance_distributions = context.stage("synthesis.population.spatial.secondary.distance_distributions")
     destinations = prepare_destinations(context)
 
+    # Build the spatial index once and share it with the workers through the file system
+    candidate_index_path = "%s/candidate_index.joblib" % context.path()
+    CandidateIndex(destinations).save(candidate_index_path)
+
     # Resampling for calibration
     resample_distributions(distance_distributions, dict(
         car = 0.0, car_passenger = 0.1, pt = 0.5, bicycle = 0.0, walk = -0.5
@@ -93,21 +112,42 @@ def execute(context):
 
     # Segment into subsamples
     processes = context.config("processes")
+    chunk_size = context.config("secloc_chunk_size")
 
-    unique_person_ids = df_trips["person_id"].unique()
+    unique_person_ids, trip_counts = np.unique(df_trips["person_id"].values, return_counts = True)
     number_of_persons = len(unique_person_ids)
-    unique_person_ids = np.array_split(unique_person_ids, processes)
+
+    if chunk_size is None:
+        # One subsample per process
+        unique_person_ids = np.array_split(unique_person_ids, processes)
+    else:
+        # Subsamples of approximately chunk_size trips, independent of the number of processes
+        unit_indices = (np.cumsum(trip_counts) - trip_counts) // chunk_size
+        unique_person_ids = np.split(unique_person_ids, np.nonzero(np.diff(unit_indices))[0] + 1)
 
     random = np.random.RandomState(context.config("random_seed"))
-    random_seeds = random.randint(10000, size = processes)
+    random_seeds = random.randint(np.iinfo(np.int32).max, size = len(unique_person_ids))
+
+    # Create batch problems for parallelization, trips and primary locations are sorted by person
+    trip_person_ids = df_trips["person_id"].values
+    primary_person_ids = df_primary["person_id"].values
 
-    # Create batch problems for parallelization
     batches = []
 
-    for index in range(processes):
+    for index, person_ids in enumerate(unique_person_ids):
+        if len(person_ids) == 0:
+            trip_slice, primary_slice = slice(0, 0), slice(0, 0)
+        else:
+            trip_slice = slice(
+                np.searchsorted(trip_person_ids, person_ids[0], side = "left"),
+                np.searchsorted(trip_person_ids, person_ids[-1], side = "right"))
+
+            primary_slice = slice(
+                np.searchsorted(primary_person_ids, person_ids[0], side = "left"),
+                np.searchsorted(primary_person_ids, person_ids[-1], side = "right"))
+
         batches.append((
-            df_trips[df_trips["person_id"].isin(unique_person_ids[index])],
-            df_primary[df_primary["person_id"].isin(unique_person_ids[index])],
+            index, df_trips.iloc[trip_slice], df_primary.iloc[primary_slice],
             random_seeds[index], crs
         ))
 
@@ -115,13 +155,16 @@ def execute(context):
     with context.progress(label = "Assigning secondary locations to persons", total = number_of_persons):
         with context.parallel(processes = processes, data = dict(
             distance_distributions = distance_distributions,
-            destinations = destinations
+            candidate_index_path = candidate_index_path
         )) as parallel:
-            df_locations, df_convergence = [], []
+            results = [None] * len(batches)
 
-            for df_locations_item, df_convergence_item in parallel.imap_unordered(process, batches):
-                df_locations.append(df_locations_item)
-                df_convergence.append(df_convergence_item)
+            for index, df_locations_item, df_convergence_item in parallel.imap_unordered(process, batches):
+                results[index] = (df_locations_item, df_convergence_item)
+
+    # Combine in a deterministic order
+    df_locations = [item[0] for item in results]
+    df_convergence = [item[1] for item in results]
 
     df_locations = pd.concat(df_locations).sort_values(by = ["person_id", "activity_index"])
     df_convergence = pd.concat(df_convergence)
@@ -130,17 +173,27 @@ def execute(context):
 
     return df_locations, df_convergence
 
+CANDIDATE_INDEX_CACHE = {}
+
+def load_candidate_index(path):
+  # Load the index only once per process (unless it has been rewritten since)
+  key = (path, os.path.getmtime(path))
+
+  if not key in CANDIDATE_INDEX_CACHE:
+    CANDIDATE_INDEX_CACHE.clear()
+    CANDIDATE_INDEX_CACHE[key] = CandidateIndex.load(path)
+
+  return CANDIDATE_INDEX_CACHE[key]
+
 def process(context, arguments):
-  df_trips, df_primary, random_seed, crs = arguments
+  batch_index, df_trips, df_primary, random_seed, crs = arguments
 
   # Set up RNG
   random = np.random.RandomState(random_seed)
   maximum_iterations = context.config("secloc_maximum_iterations")
 
-  # Set up discretization solver
-  destinations = context.data("destinations")
-  candidate_index = CandidateIndex(destinations)
-  discretization_solver = CustomDiscretizationSolver(candidate_index)
+  # Load candidate index
+  candidate_index = load_candidate_index(context.data("candidate_index_path"))
 
   # Set up distance sampler
   distance_distributions = context.data("distance_distributions")
@@ -169,6 +222,10 @@ def process(context, arguments):
     bicycle = 100.0, walk = 100.0
   )
 
+  # Set up discretization solver; optionally choose among multiple nearby candidates
+  discretization_candidates = context.config("secloc_discretization_candidates")
+  discretization_solver = CustomDiscretizationSolver(candidate_index, thresholds, discretization_candidates)
+
   assignment_objective = DiscretizationErrorObjective(thresholds = thresholds)
   assignment_solver = AssignmentSolver(
       distance_sampler = distance_sampler,
@@ -178,32 +235,63 @@ def process(context, arguments):
       maximum_iterations = min(20, maximum_iterations)
       )
 
-  df_locations = []
-  df_convergence = []
+  if context.config("secloc_solver") == "batch":
+      # Solve all problems of this subsample in vectorized batches
+      batch_solver = BatchAssignmentSolver(
+          distance_sampler = BatchDistanceSampler(
+              random = random,
+              distributions = distance_distributions,
+              leisure_correction_factor = leisure_correction_factor,
+              maximum_iterations = min(1000, maximum_iterations)),
+          relaxation_solver = BatchRelaxationSolver(random, chain_solver, candidate_index),
+          discretization_solver = BatchDiscretizationSolver(candidate_index, thresholds, discretization_candidates),
+          objective = BatchDiscretizationErrorObjective(thresholds = thresholds),
+          maximum_iterations = min(20, maximum_iterations),
+          batch_size = context.config("secloc_batch_size"))
+
+      problems = extract_assignment_problems(df_trips, df_primary)
+      result = batch_solver.solve(problems)
+
+      activity_problems = np.repeat(np.arange(len(problems["sizes"])), problems["sizes"])
+      activity_offsets = np.arange(len(problems["purposes"])) - problems["offsets"][activity_problems]
+
+      df_locations = pd.DataFrame(dict(
+          person_id = problems["person_ids"][activity_problems],
+          activity_index = problems["activity_indices"][activity_problems] + activity_offsets,
+          location_id = list(result["identifiers"]),
+          geometry = gpd.points_from_xy(result["locations"][:, 0], result["locations"][:, 1])
+      ))
+
+      df_convergence = pd.DataFrame(dict(valid = result["valid"], size = problems["sizes"]))
+      context.progress.update(len(np.unique(problems["person_ids"])))
 
-  last_person_id = None
+  else:
+      df_locations = []
+      df_convergence = []
 
-  for problem in find_assignment_problems(df_trips, df_primary):
-      result = assignment_solver.solve(problem)
+      last_person_id = None
 
-      starting_activity_index = problem["activity_index"]
+      for problem in find_assignment_problems(df_trips, df_primary):
+          result = assignment_solver.solve(problem)
+          starting_activity_index = problem["activity_index"]
 
-      for index, (identifier, location) in enumerate(zip(result["discretization"]["identifiers"], result["discretization"]["locations"])):
-          df_locations.append((
-              problem["person_id"], starting_activity_index + index, identifier, geo.Point(location)
+          for index, (identifier, location) in enumerate(zip(result["discretization"]["identifiers"], result["discretization"]["locations"])):
+              df_locations.append((
+                  problem["person_id"], starting_activity_index + index, identifier, geo.Point(location)
+              ))
+
+          df_convergence.append((
+              result["valid"], problem["size"]
           ))
 
-      df_convergence.append((
-          result["valid"], problem["size"]
-      ))
+          if problem["person_id"] != last_person_id:
+              last_person_id = problem["person_id"]
+              context.progress.update()
 
-      if problem["person_id"] != last_person_id:
-          last_person_id = problem["person_id"]
-          context.progress.update()
+      df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "activity_index", "location_id", "geometry"])
+      df_convergence = pd.DataFrame.from_records(df_convergence, columns = ["valid", "size"])
 
-  df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "activity_index", "location_id", "geometry"])
   df_locations = gpd.GeoDataFrame(df_locations, crs = crs)
   assert not df_locations["geometry"].isna().any()
 
-  df_convergence = pd.DataFrame.from_records(df_convergence, columns = ["valid", "size"])
-  return df_locations, df_convergence
+  return batch_index, df_locations, df_convergence
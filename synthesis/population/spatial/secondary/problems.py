@@ -1,93 +1,114 @@
 import numpy as np
-import pandas as pd
+import geopandas as gpd
 
-FIELDS = ["person_id", "trip_index", "preceding_purpose", "following_purpose", "mode", "travel_time"]
 FIXED_PURPOSES = ["home", "work", "education"]
 
-def find_bare_assignment_problems(df):
-    problem = None
-
-    for row in df[FIELDS].itertuples(index = False):
-        person_id, trip_index, preceding_purpose, following_purpose, mode, travel_time = row
-
-        if not problem is None and person_id != problem["person_id"]:
-            # We switch person, but we're still tracking a problem. This is a tail!
-            yield problem
-            problem = None
-
-        if problem is None:
-            # Start a new problem
-            problem = dict(
-                person_id = person_id, trip_index = trip_index, purposes = [preceding_purpose],
-                modes = [], travel_times = []
-            )
-
-        problem["purposes"].append(following_purpose)
-        problem["modes"].append(mode)
-        problem["travel_times"].append(travel_time)
-
-        if problem["purposes"][-1] in FIXED_PURPOSES:
-            # The current chain (or initial tail) ends with a fixed activity.
-            yield problem
-            problem = None
-
-    if not problem is None:
-        yield problem
-
-LOCATION_FIELDS = ["person_id", "home", "work", "education"]
+def extract_assignment_problems(df, df_locations):
+    """
+        Extracts the assignment problems from the trips (sorted by person and trip
+        index) as a structure of arrays:
+          - person_ids, trip_indices, activity_indices and sizes per problem
+          - purposes of the variable activities, problem i covers
+            offsets[i]:offsets[i + 1]
+          - modes and travel times of the trips, problem i covers
+            trip_offsets[i]:trip_offsets[i + 1]
+          - origins and destinations per problem, NaN if not fixed
+    """
+    person_ids = df["person_id"].values
+    trip_indices = df["trip_index"].values
+    preceding_purposes = df["preceding_purpose"].values.astype(object)
+    following_purposes = df["following_purpose"].values.astype(object)
+
+    # A chain (or tail) ends with a fixed activity or with the last trip of a person
+    f_end = np.isin(following_purposes, FIXED_PURPOSES)
+    f_end[:-1] |= person_ids[1:] != person_ids[:-1]
+    if len(f_end) > 0: f_end[-1] = True
+
+    trip_ends = np.nonzero(f_end)[0] + 1
+    trip_starts = np.concatenate([[0], trip_ends])[:-1].astype(int)
+
+    f_fixed_origin = np.isin(preceding_purposes[trip_starts], FIXED_PURPOSES)
+    f_fixed_destination = np.isin(following_purposes[trip_ends - 1], FIXED_PURPOSES)
+
+    # Variable activities: the initial activity if not fixed, then all following activities except a fixed last one
+    trip_counts = trip_ends - trip_starts
+    sizes = trip_counts + ~f_fixed_origin - f_fixed_destination
+
+    # We can skip if there are no variable activities
+    f_keep = sizes > 0
+    trip_starts, trip_ends, trip_counts, sizes = trip_starts[f_keep], trip_ends[f_keep], trip_counts[f_keep], sizes[f_keep]
+    f_fixed_origin, f_fixed_destination = f_fixed_origin[f_keep], f_fixed_destination[f_keep]
+
+    trip_offsets = np.concatenate([[0], np.cumsum(trip_counts)]).astype(int)
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+
+    trip_selection = np.repeat(trip_starts - trip_offsets[:-1], trip_counts) + np.arange(trip_offsets[-1])
+
+    # Purposes are the following purposes of the trips, preceded by the initial activity if variable
+    activity_problems = np.repeat(np.arange(len(sizes)), sizes)
+    activity_positions = np.arange(offsets[-1]) - offsets[:-1][activity_problems]
+    activity_trips = trip_starts[activity_problems] + activity_positions - ~f_fixed_origin[activity_problems]
+
+    purposes = following_purposes[np.maximum(activity_trips, 0)]
+    f_initial = activity_trips < trip_starts[activity_problems]
+    purposes[f_initial] = preceding_purposes[trip_starts[activity_problems[f_initial]]]
+
+    # Fixed locations of the persons
+    problem_person_ids = person_ids[trip_starts]
+    location_person_ids = df_locations["person_id"].values
+    location_indices = np.searchsorted(location_person_ids, problem_person_ids)
+
+    coordinates = {}
+    for purpose in FIXED_PURPOSES:
+        points = gpd.GeoSeries(df_locations[purpose].values)
+        coordinates[purpose] = np.vstack([points.x.values, points.y.values]).T[location_indices]
+
+    origins = np.full((len(sizes), 2), np.nan)
+    destinations = np.full((len(sizes), 2), np.nan)
+
+    for purpose in FIXED_PURPOSES:
+        f = f_fixed_origin & (preceding_purposes[trip_starts] == purpose)
+        origins[f] = coordinates[purpose][f]
+
+        f = f_fixed_destination & (following_purposes[trip_ends - 1] == purpose)
+        destinations[f] = coordinates[purpose][f]
+
+    problem_trip_indices = trip_indices[trip_starts]
+
+    return dict(
+        person_ids = problem_person_ids,
+        trip_indices = problem_trip_indices,
+        activity_indices = problem_trip_indices + f_fixed_origin,
+        sizes = sizes,
+        offsets = offsets, purposes = purposes,
+        trip_offsets = trip_offsets,
+        modes = df["mode"].values.astype(object)[trip_selection],
+        travel_times = df["travel_time"].values.astype(float)[trip_selection],
+        has_origin = f_fixed_origin, has_destination = f_fixed_destination,
+        origins = origins, destinations = destinations
+    )
 
 def find_assignment_problems(df, df_locations):
     """
-        Enriches assignment problems with:
+        Yields the assignment problems one by one with:
           - Locations of the fixed activities
           - Size of the problem
           - Reduces purposes to the variable ones
     """
-    location_iterator = df_locations[LOCATION_FIELDS].itertuples(index = False)
-    current_location = None
-
-    for problem in find_bare_assignment_problems(df):
-        origin_purpose = problem["purposes"][0]
-        destination_purpose = problem["purposes"][-1]
-
-        # Reduce purposes
-        if origin_purpose in FIXED_PURPOSES and destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:-1]
-
-        elif origin_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:]
-
-        elif destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][:-1]
-
-        else:
-            pass # Neither chain nor tail
-
-        # Define size
-        problem["size"] = len(problem["purposes"])
-
-        if problem["size"] == 0:
-            continue # We can skip if there are no variable activities
-
-        # Advance location iterator until we arrive at the current problem's person
-        while current_location is None or current_location[0] != problem["person_id"]:
-            current_location = next(location_iterator)
-
-        # Define origin and destination locations if they have fixed purposes
-        problem["origin"] = None
-        problem["destination"] = None
-
-        if origin_purpose in FIXED_PURPOSES:
-            problem["origin"] = current_location[LOCATION_FIELDS.index(origin_purpose)] # Shapely POINT
-            problem["origin"] = np.array([[problem["origin"].x, problem["origin"].y]])
-
-        if destination_purpose in FIXED_PURPOSES:
-            problem["destination"] = current_location[LOCATION_FIELDS.index(destination_purpose)] # Shapely POINT
-            problem["destination"] = np.array([[problem["destination"].x, problem["destination"].y]])
-
-        if problem["origin"] is None:
-            problem["activity_index"] = problem["trip_index"]
-        else:
-            problem["activity_index"] = problem["trip_index"] + 1
+    problems = extract_assignment_problems(df, df_locations)
+    offsets, trip_offsets = problems["offsets"], problems["trip_offsets"]
+
+    for index in range(len(problems["sizes"])):
+        problem = dict(
+            person_id = problems["person_ids"][index],
+            trip_index = problems["trip_indices"][index],
+            purposes = list(problems["purposes"][offsets[index]:offsets[index + 1]]),
+            modes = list(problems["modes"][trip_offsets[index]:trip_offsets[index + 1]]),
+            travel_times = list(problems["travel_times"][trip_offsets[index]:trip_offsets[index + 1]]),
+            size = problems["sizes"][index],
+            origin = problems["origins"][index].reshape(1, 2) if problems["has_origin"][index] else None,
+            destination = problems["destinations"][index].reshape(1, 2) if problems["has_destination"][index] else None,
+            activity_index = problems["activity_indices"][index]
+        )
 
         yield problem
@@ -1,5 +1,6 @@
 import numpy as np
 import numpy.linalg as la
+import numba
 
 def check_feasibility(distances, direct_distance, consider_total_distance = True):
     return calculate_feasibility(distances, direct_distance, consider_total_distance) == 0.0
@@ -16,8 +17,21 @@ def calculate_feasibility(distances, direct_distance, consider_total_distance =
 
     return float(max(delta, 0))
 
+def calculate_feasibilities(distances, direct_distances):
+    """
+        Vectorized version of `calculate_feasibility` for a (N, T) array of
+        distances and a (N,) array of direct distances.
+    """
+    total_distances = np.sum(distances, axis = 1)
+    remaining_distances = total_distances[:, np.newaxis] - distances
+
+    delta = np.max(distances - direct_distances[:, np.newaxis] - remaining_distances, axis = 1)
+    delta = np.maximum(delta, direct_distances - total_distances)
+
+    return np.maximum(delta, 0.0)
+
 class DiscretizationSolver:
-    def solve(self, problem, locations):
+    def solve(self, problem, locations, distances = None):
         raise NotImplementedError()
 
 class RelaxationSolver:
@@ -48,7 +62,7 @@ class AssignmentSolver:
             distance_result = self.distance_sampler.sample(problem)
 
             relaxation_result = self.relaxation_solver.solve(problem, distance_result["distances"])
-            discretization_result = self.discretization_solver.solve(problem, relaxation_result["locations"])
+            discretization_result = self.discretization_solver.solve(problem, relaxation_result["locations"], distance_result["distances"])
 
             assignment_result = self.objective.evaluate(problem, distance_result, relaxation_result, discretization_result)
 
@@ -116,6 +130,70 @@ class AngularTailSolver(RelaxationSolver):
         assert len(locations) == len(distances)
         return dict(valid = True, locations = locations)
 
+@numba.jit(nopython = True)
+def run_gravity_simulation(locations, distances, offsets, alpha, eps, maximum_iterations, valid, iterations):
+    """
+        Runs the gravity simulation in place on a packed set of chains. Chain i
+        has the trips offsets[i]:offsets[i + 1] in `distances` and the points
+        (including origin and destination) offsets[i] + i:offsets[i + 1] + i + 1
+        in `locations`. Convergence and the number of iterations are written to
+        `valid` and `iterations` per chain.
+    """
+    maximum_trips = 0
+
+    for i in range(len(offsets) - 1):
+        maximum_trips = max(maximum_trips, offsets[i + 1] - offsets[i])
+
+    directions = np.zeros((maximum_trips, 2))
+    deltas = np.zeros((maximum_trips,))
+
+    for i in range(len(offsets) - 1):
+        first_trip = offsets[i]
+        trips = offsets[i + 1] - first_trip
+        first_point = first_trip + i
+
+        valid[i] = False
+        iterations[i] = maximum_iterations - 1
+
+        for k in range(maximum_iterations):
+            converged = True
+
+            for j in range(trips):
+                dx = locations[first_point + j, 0] - locations[first_point + j + 1, 0]
+                dy = locations[first_point + j, 1] - locations[first_point + j + 1, 1]
+                length = np.sqrt(dx * dx + dy * dy)
+
+                deltas[j] = distances[first_trip + j] - length
+                if length < 1.0: length = 1.0
+
+                directions[j, 0] = dx / length
+                directions[j, 1] = dy / length
+
+                if not np.abs(deltas[j]) < eps:
+                    converged = False
+
+            if converged:
+                valid[i] = True
+                iterations[i] = k
+                break
+
+            # Apply adjustment to the variable locations
+            for j in range(1, trips):
+                origin_weight = 2.0 if j == 1 else 1.0
+                destination_weight = 2.0 if j == trips - 1 else 1.0
+
+                for d in range(2):
+                    adjustment = -(0.5 * alpha * deltas[j - 1] * directions[j - 1, d] * origin_weight)
+                    adjustment += 0.5 * alpha * deltas[j] * directions[j, d] * destination_weight
+                    locations[first_point + j, d] += adjustment
+
+            for j in range(1, trips):
+                for d in range(2):
+                    if not np.isfinite(locations[first_point + j, d]):
+                        raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+
+    return valid, iterations
+
 class GravityChainSolver:
     def __init__(self, random, alpha = 0.3, eps = 1.0, maximum_iterations = 1000, lateral_deviation = None):
         self.alpha = 0.3
@@ -216,51 +294,32 @@ class GravityChainSolver:
         lateral_deviation = self.lateral_deviation if not self.lateral_deviation is None else max(direct_distance, 1.0)
         locations[1:-1] += normal * 2.0 * (self.random.normal(size = len(distances) - 1)[:, np.newaxis] - 0.5) * lateral_deviation
 
-        # Prepare gravity simulation
-        valid = False
-
-        origin_weights = np.ones((len(distances) - 1, 2))
-        origin_weights[0,:] = 2.0
-
-        destination_weights = np.ones((len(distances) - 1, 2))
-        destination_weights[-1,:] = 2.0
-
         # Run gravity simulation
-        for k in range(self.maximum_iterations):
-            directions = locations[:-1] - locations[1:]
-            lengths = la.norm(directions, axis = 1)
-
-            offset = distances - lengths
-            lengths[lengths < 1.0] = 1.0
-            directions /= lengths[:, np.newaxis]
-
-            if np.all(np.abs(offset) < self.eps): # Check if we have converged
-                valid = True
-                break
-
-            # Apply adjustment to locations
-            adjustment = np.zeros((len(distances) - 1, 2))
-            adjustment -= 0.5 * self.alpha * offset[:-1, np.newaxis] * directions[:-1] * origin_weights
-            adjustment += 0.5 * self.alpha * offset[1:, np.newaxis] * directions[1:] * destination_weights
+        valid = np.zeros((1,), dtype = bool)
+        iterations = np.zeros((1,), dtype = np.int64)
 
-            locations[1:-1] += adjustment
-
-            if np.isnan(locations).any() or np.isinf(locations).any():
-                raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+        run_gravity_simulation(
+            locations, np.asarray(distances, dtype = float), np.array([0, len(distances)]),
+            self.alpha, self.eps, self.maximum_iterations, valid, iterations)
 
         return dict(
-            valid = valid, locations = locations[1:-1], iterations = k
+            valid = bool(valid[0]), locations = locations[1:-1], iterations = int(iterations[0])
         )
 
 class FeasibleDistanceSampler(DistanceSampler):
-    def __init__(self, random, maximum_iterations = 1000):
+    def __init__(self, random, maximum_iterations = 1000, maximum_block_size = 1):
         self.maximum_iterations = maximum_iterations
+        self.maximum_block_size = maximum_block_size
         self.random = random
 
     def sample_distances(self, problem):
         # Return distance chains per row
         raise NotImplementedError()
 
+    def sample_distance_block(self, problem, count):
+        # Return multiple distance chains, consuming random numbers as consecutive calls would
+        return np.vstack([self.sample_distances(problem) for k in range(count)])
+
     def sample(self, problem):
         origin, destination = problem["origin"], problem["destination"]
 
@@ -285,25 +344,42 @@ class FeasibleDistanceSampler(DistanceSampler):
 
             return dict(valid = True, distances = distances, iterations = None)
 
-        # This is the general case
+        # This is the general case: Candidates are drawn in growing blocks
         best_distances = None
         best_delta = None
 
-        for k in range(self.maximum_iterations):
-            distances = self.sample_distances(problem)
-            delta = calculate_feasibility(distances, direct_distance)
+        k = 0
+        block_size = 1
+
+        while k < self.maximum_iterations:
+            count = min(block_size, self.maximum_iterations - k)
+            state = self.random.get_state() if count > 1 else None
 
-            if best_delta is None or delta < best_delta:
-                best_delta = delta
-                best_distances = distances
+            distances = self.sample_distance_block(problem, count)
+            deltas = calculate_feasibilities(distances, direct_distance)
 
-                if delta == 0.0:
+            index = np.argmin(deltas)
+
+            if best_delta is None or deltas[index] < best_delta:
+                best_delta = float(deltas[index])
+                best_distances = distances[index]
+
+                if best_delta == 0.0:
+                    # Rewind the random state so that only the candidates up to the feasible one are consumed
+                    if index < count - 1:
+                        self.random.set_state(state)
+                        self.sample_distance_block(problem, index + 1)
+
+                    k += index
                     break
 
+            k += count
+            block_size = min(2 * block_size, self.maximum_block_size)
+
         return dict(
             valid = best_delta == 0.0,
             distances = best_distances,
-            iterations = k
+            iterations = min(k, self.maximum_iterations - 1)
         )
 
 class DiscretizationErrorObjective(AssignmentObjective):
@@ -14,44 +14,28 @@ def configure(context):
     context.stage("data.vehicles.types")
 
     context.config("vehicles_year", 2021)
+    context.config("random_seed")
 
-def _sample_vehicle(context, args):
-    vehicle = args
-    year = context.config("vehicles_year")
-    df_vehicle_fleet_counts, df_vehicle_age_counts = context.data("fleet"), context.data("age")
-
-    commune_id = vehicle["commune_id"]
-
-    if  commune_id in df_vehicle_fleet_counts["commune_id"].unique():
-        fleet = df_vehicle_fleet_counts.loc[df_vehicle_fleet_counts["commune_id"] == commune_id]
-        choice = fleet.sample(weights="fleet")
-        critair = choice["critair"].values[0]
-        technology = choice["technology"].values[0]
+def _sample_commune(context, args):
+    commune_index, count, seed = args
+    random = np.random.RandomState(seed)
 
-        age_mask = (df_vehicle_age_counts["critair"] == critair) & (df_vehicle_age_counts["technology"] == technology)
-        age = df_vehicle_age_counts.loc[age_mask].sample(weights="fleet")["age"].values[0]
-    else:
-        choice = df_vehicle_age_counts.sample(weights="fleet")
-        critair = choice["critair"].values[0]
-        technology = choice["technology"].values[0]
-        age = choice["age"].values[0]
+    combination_cdf = context.data("combination_cdf")[commune_index]
+    age_offsets, age_cdf = context.data("age_offsets"), context.data("age_cdf")
 
-    vehicle["critair"] = critair
-    vehicle["technology"] = technology
-    vehicle["age"] = age
+    # Sample (critair, technology) and then the age given the combination
+    combinations = np.searchsorted(combination_cdf, random.random_sample(count), side = "right")
+    u = random.random_sample(count)
 
-    euro = _get_euro_from_critair(vehicle, year)
-    vehicle["euro"] = euro
+    indices = np.zeros((count,), dtype = int)
 
-    if technology == "Gazole":
-        hbefa_tech = "diesel"
-        vehicle["type_id"] = "car_%s_%s" % (hbefa_tech, euro)
-    if technology == "Essence":
-        hbefa_tech = "petrol"
-        vehicle["type_id"] = "car_%s_%s" % (hbefa_tech, euro)
+    for combination in np.unique(combinations):
+        f = combinations == combination
+        start, end = age_offsets[combination], age_offsets[combination + 1]
+        indices[f] = start + np.searchsorted(age_cdf[start:end], u[f], side = "right")
 
-    context.progress.update()
-    return vehicle
+    context.progress.update(count)
+    return indices
 
 def _get_euro_from_critair(vehicle, year):
 
@@ -62,7 +46,7 @@ def _get_euro_from_critair(vehicle, year):
     # we are using the following table : https://www.ecologie.gouv.fr/sites/default/files/Tableau_classification_des_vehicules.pdf
     age_num = re.findall(r'\d+', age)
     if len(age_num) == 0:
-        raise RuntimeError("Badly formatted 'age' variable found for vehicle (id: %s) : %s" % (age, vehicle["vehicle_id"]))
+        raise RuntimeError("Badly formatted 'age' variable found in the vehicle fleet: %s" % age)
 
     birthday = int(year) - int(age_num[0])
 
@@ -127,14 +111,83 @@ def execute(context):
     df_vehicles["mode"] = "car"
 
     df_vehicle_fleet_counts, df_vehicle_age_counts = context.stage("data.vehicles.raw")
+    year = context.config("vehicles_year")
 
-    res = []
+    # Age distributions by (critair, technology), the regions are merged
+    df_ages = df_vehicle_age_counts.groupby(["critair", "technology", "age"])["fleet"].sum().reset_index()
+    df_ages["combination_index"] = df_ages.groupby(["critair", "technology"]).ngroup()
 
-    with context.progress(label = "Processing vehicles data ...", total = len(df_vehicles)) as progress:
-        with context.parallel(dict(fleet = df_vehicle_fleet_counts, age = df_vehicle_age_counts)) as parallel:
-            for df_partial in parallel.imap(_sample_vehicle, df_vehicles.to_dict(orient="records")):
-                res.append(df_partial)
+    df_combinations = df_ages[["critair", "technology", "combination_index"]].drop_duplicates()
+    combination_count = len(df_combinations)
+
+    age_offsets = np.zeros((combination_count + 1,), dtype = int)
+    age_offsets[1:] = np.cumsum(np.bincount(df_ages["combination_index"], minlength = combination_count))
+
+    age_totals = np.bincount(df_ages["combination_index"], df_ages["fleet"], minlength = combination_count)
+    age_cdf = df_ages.groupby("combination_index")["fleet"].cumsum().values.astype(float)
+
+    row_totals = age_totals[df_ages["combination_index"].values]
+    age_cdf = np.divide(age_cdf, row_totals, out = np.zeros_like(age_cdf), where = row_totals > 0)
+
+    # Euro class and vehicle type of each row in the age distributions
+    df_ages["euro"] = [_get_euro_from_critair(row, year) for row in df_ages[["critair", "technology", "age"]].to_dict(orient = "records")]
+
+    df_ages["type_id"] = "default_car"
+    df_ages.loc[df_ages["technology"] == "Gazole", "type_id"] = "car_diesel_" + df_ages["euro"]
+    df_ages.loc[df_ages["technology"] == "Essence", "type_id"] = "car_petrol_" + df_ages["euro"]
+
+    # Fleet by commune, with the total regional fleet as the last row for communes without data
+    df_fleet = df_vehicle_fleet_counts.groupby(["commune_id", "critair", "technology"], observed = True)["fleet"].sum().reset_index()
+    df_fleet = pd.merge(df_fleet, df_combinations, on = ["critair", "technology"], how = "left")
+
+    if df_fleet["combination_index"].isna().any():
+        raise RuntimeError("Found fleet combinations of critair and technology without age distribution")
 
-    df_vehicles = pd.DataFrame.from_dict(res)
+    communes = pd.Index(np.unique(df_fleet["commune_id"].astype(str)))
 
-    return df_vehicle_types, df_vehicles
\ No newline at end of file
+    combination_weights = np.zeros((len(communes) + 1, combination_count))
+    np.add.at(combination_weights, (communes.get_indexer(df_fleet["commune_id"].astype(str)), df_fleet["combination_index"].astype(int)), df_fleet["fleet"].values)
+    combination_weights[-1] = age_totals
+
+    f_empty = (age_totals <= 0) & np.any(combination_weights > 0, axis = 0)
+
+    if np.any(f_empty):
+        raise RuntimeError("Found fleet combinations of critair and technology without age weight: {}".format(
+            df_combinations[f_empty[df_combinations["combination_index"].values]][["critair", "technology"]].to_dict(orient = "records")))
+
+    # Group the vehicles by commune
+    commune_indices = communes.get_indexer(df_vehicles["commune_id"].astype(str))
+    commune_indices[commune_indices < 0] = len(communes)
+
+    sorter = np.argsort(commune_indices, kind = "stable")
+    unique_indices, counts = np.unique(commune_indices[sorter], return_counts = True)
+
+    # Only the rows of communes with vehicles are used
+    combination_cdf = np.cumsum(combination_weights, axis = 1)
+    f_empty = combination_cdf[unique_indices, -1] <= 0
+
+    if np.any(f_empty):
+        raise RuntimeError("Found communes without vehicle fleet: {}".format(
+            [communes[index] if index < len(communes) else "regional fleet" for index in unique_indices[f_empty]]))
+
+    combination_cdf[unique_indices] /= combination_cdf[unique_indices, -1:]
+
+    random = np.random.RandomState(context.config("random_seed") + 7341)
+    seeds = random.randint(np.iinfo(np.int32).max, size = len(unique_indices))
+
+    indices = np.zeros((len(df_vehicles),), dtype = int)
+    offset = 0
+
+    with context.progress(label = "Processing vehicles data ...", total = len(df_vehicles)) as progress:
+        with context.parallel(dict(combination_cdf = combination_cdf, age_offsets = age_offsets, age_cdf = age_cdf)) as parallel:
+            for partial_indices in parallel.imap(_sample_commune, zip(unique_indices.tolist(), counts.tolist(), seeds.tolist())):
+                indices[sorter[offset:offset + len(partial_indices)]] = partial_indices
+                offset += len(partial_indices)
+
+    df_vehicles["type_id"] = df_ages["type_id"].values[indices]
+    df_vehicles["critair"] = df_ages["critair"].values[indices]
+    df_vehicles["technology"] = df_ages["technology"].values[indices]
+    df_vehicles["age"] = df_ages["age"].values[indices]
+    df_vehicles["euro"] = df_ages["euro"].values[indices]
+
+    return df_vehicle_types, df_vehicles
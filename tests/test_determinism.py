@@ -154,3 +154,47 @@ def _test_determinism_matsim(index, data_path, tmpdir):
 
     for file in REFERENCE_HASHES.keys():
         assert REFERENCE_HASHES[file] == generated_hashes[file]
+
+def test_determinism_secondary_batch(tmpdir):
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    results = []
+
+    for index, solver in enumerate(["sequential", "batch", "batch"]):
+        cache_path = str(tmpdir.mkdir("cache_%d" % index))
+        output_path = str(tmpdir.mkdir("output_%d" % index))
+        config = dict(
+            data_path = data_path, output_path = output_path,
+            regions = [10, 11], sampling_rate = 1.0, hts = "entd",
+            random_seed = 1000, processes = 2,
+            secloc_maximum_iterations = 10,
+            secloc_solver = solver, secloc_chunk_size = 50,
+            maven_skip_tests = True,
+            matching_attributes = [
+                "sex", "any_cars", "age_class", "socioprofessional_class",
+                "income_class", "departement_id"
+            ]
+        )
+
+        stages = [
+            dict(descriptor = "synthesis.population.spatial.secondary.locations"),
+        ]
+
+        results.append(synpp.run(stages, config, working_directory = cache_path)[0])
+
+    (df_sequential_locations, df_sequential_convergence), (df_locations, df_convergence), (df_repeated_locations, df_repeated_convergence) = results
+
+    # The batch solver provides the same schema as the sequential one
+    assert list(df_locations.columns) == list(df_sequential_locations.columns)
+    assert list(df_locations.dtypes) == list(df_sequential_locations.dtypes)
+    assert df_locations.crs == df_sequential_locations.crs
+    assert len(df_locations) == len(df_sequential_locations)
+
+    assert list(df_convergence.columns) == list(df_sequential_convergence.columns)
+    assert list(df_convergence.dtypes) == list(df_sequential_convergence.dtypes)
+    assert df_convergence["size"].sum() == df_sequential_convergence["size"].sum()
+
+    # Same random seed, same result
+    assert df_locations.equals(df_repeated_locations)
+    assert df_convergence.equals(df_repeated_convergence)
@@ -1,6 +1,6 @@
 import synpp
 import os
-import hashlib
+import hashlib, glob, gzip
 from . import testdata
 
 def test_simulation(tmpdir):
@@ -31,3 +31,43 @@ def test_simulation(tmpdir):
     assert os.path.isfile("%s/ile_de_france_households.xml.gz" % output_path)
     assert os.path.isfile("%s/ile_de_france_facilities.xml.gz" % output_path)
     assert os.path.isfile("%s/ile_de_france_vehicles.xml.gz" % output_path)
+
+def test_sharded_output(tmpdir):
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    stages = ["matsim.scenario.population", "matsim.scenario.households", "matsim.scenario.vehicles"]
+    outputs = []
+
+    for index, (sharded, byte_identical) in enumerate([(False, False), (True, False), (True, True)]):
+        cache_path = str(tmpdir.mkdir("cache_%d" % index))
+        output_path = str(tmpdir.mkdir("output_%d" % index))
+
+        config = dict(
+            data_path = data_path, output_path = output_path,
+            regions = [10, 11], sampling_rate = 1.0, hts = "entd",
+            random_seed = 1000, processes = 2,
+            secloc_maximum_iterations = 10,
+            matsim_sharded_output = sharded,
+            matsim_sharded_byte_identical = byte_identical,
+            maven_skip_tests = True
+        )
+
+        results = synpp.run([dict(descriptor = stage) for stage in stages], config, working_directory = cache_path)
+
+        contents = {}
+
+        for stage, name in zip(stages, results):
+            path, = glob.glob("%s/%s__*.cache/%s" % (cache_path, stage, name))
+
+            with open(path, "rb") as f:
+                contents[name] = f.read()
+
+        outputs.append(contents)
+
+    # Sharded writing produces the same content, and the same files byte by byte if requested
+    assert outputs[0].keys() == outputs[1].keys() == outputs[2].keys()
+
+    for name in outputs[0].keys():
+        assert gzip.decompress(outputs[0][name]) == gzip.decompress(outputs[1][name])
+        assert outputs[0][name] == outputs[2][name]